@@ -18,10 +18,10 @@ COMPILE_ARGS = ("-Wall -g -O2 -shared -fPIC"
 SSE_FLAGS = "-mfpmath=sse -msse2"
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
-    'pollreactor.c', 'msgblock.c', 'trdispatch.c',
+    'pollreactor.c', 'msgblock.c', 'trdispatch.c', 'lookahead.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_deltesian.c', 'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c',
-    'kin_extruder.c', 'kin_shaper.c',
+    'kin_extruder.c', 'kin_shaper.c', 'bedmesh.c', 'stepgen.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
@@ -75,6 +75,16 @@ defs_itersolve = """
     void itersolve_set_position(struct stepper_kinematics *sk
         , double x, double y, double z);
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+    void itersolve_set_linear_solver(struct stepper_kinematics *sk
+        , int enable);
+"""
+
+defs_stepgen = """
+    struct stepgen *stepgen_alloc(int num_threads);
+    void stepgen_free(struct stepgen *sg);
+    int32_t stepgen_generate_steps(struct stepgen *sg
+        , struct stepper_kinematics **sks, int count, double flush_time
+        , double compress_time);
 """
 
 defs_trapq = """
@@ -90,6 +100,8 @@ defs_trapq = """
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    #define TRAPQ_APPEND_FIELDS 13
+    void trapq_append_batch(struct trapq *tq, double *moves, int count);
     struct trapq *trapq_alloc(void);
     void trapq_free(struct trapq *tq);
     void trapq_finalize_moves(struct trapq *tq, double print_time);
@@ -99,6 +111,37 @@ defs_trapq = """
         , double start_time, double end_time);
 """
 
+defs_lookahead = """
+    struct lookahead_move {
+        double max_start_v2, max_cruise_v2, delta_v2;
+        double max_smoothed_v2, smooth_delta_v2;
+    };
+    struct lookahead_junction {
+        double start_v2, cruise_v2, end_v2;
+    };
+
+    int lookahead_flush(struct lookahead_move *moves
+        , struct lookahead_junction *junctions, int count, int lazy);
+"""
+
+defs_bedmesh = """
+    struct bedmesh *bedmesh_alloc(void);
+    void bedmesh_free(struct bedmesh *bm);
+    void bedmesh_set_mesh(struct bedmesh *bm, double *z_vals
+        , int x_count, int y_count, double min_x, double min_y
+        , double x_dist, double y_dist);
+    void bedmesh_set_offsets(struct bedmesh *bm, double x_offset
+        , double y_offset);
+    double bedmesh_calc_z(struct bedmesh *bm, double x, double y);
+    int bedmesh_split_move(struct bedmesh *bm, double *prev_pos
+        , double *next_pos, double z_factor, double fade_offset
+        , double move_check_distance, double split_delta_z
+        , double *out, int max);
+    int bedmesh_split_move_grid(struct bedmesh *bm, double *prev_pos
+        , double *next_pos, double z_factor, double fade_offset
+        , double split_delta_z, double *out, int max);
+"""
+
 defs_kin_cartesian = """
     struct stepper_kinematics *cartesian_stepper_alloc(char axis);
     struct stepper_kinematics *cartesian_reverse_stepper_alloc(char axis);
@@ -171,6 +214,8 @@ defs_serialqueue = """
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock
         , uint64_t notify_id);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
     void serialqueue_set_wire_frequency(struct serialqueue *sq
@@ -200,6 +245,8 @@ defs_trdispatch = """
 defs_pyhelper = """
     void set_python_logging_callback(void (*func)(const char *));
     double get_monotonic(void);
+    void seqlock_write(char *base, int seq_offset, int data_offset
+        , char *data, int len);
 """
 
 defs_std = """
@@ -208,7 +255,8 @@ defs_std = """
 
 defs_all = [
     defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_itersolve, defs_trapq, defs_trdispatch,
+    defs_itersolve, defs_stepgen, defs_trapq, defs_trdispatch,
+    defs_lookahead, defs_bedmesh,
     defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
     defs_kin_deltesian, defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch,
     defs_kin_extruder, defs_kin_shaper,
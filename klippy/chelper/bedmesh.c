@@ -0,0 +1,322 @@
+// Bed mesh z adjustment lookup and move splitting
+//
+// Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
+// Copyright (C) 2018-2019 Eric Callahan <arksine.code@gmail.com>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <math.h> // sqrt
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+
+// Interpolated mesh (stored in row major order - one row per y index)
+struct bedmesh {
+    double *z_vals;
+    int x_count, y_count;
+    double min_x, min_y, x_dist, y_dist;
+    double x_offset, y_offset;
+};
+
+struct bedmesh * __visible
+bedmesh_alloc(void)
+{
+    struct bedmesh *bm = malloc(sizeof(*bm));
+    memset(bm, 0, sizeof(*bm));
+    return bm;
+}
+
+void __visible
+bedmesh_free(struct bedmesh *bm)
+{
+    free(bm->z_vals);
+    free(bm);
+}
+
+// Store a copy of the interpolated mesh
+void __visible
+bedmesh_set_mesh(struct bedmesh *bm, double *z_vals, int x_count, int y_count
+                 , double min_x, double min_y, double x_dist, double y_dist)
+{
+    free(bm->z_vals);
+    bm->z_vals = NULL;
+    bm->x_count = bm->y_count = 0;
+    if (x_count < 2 || y_count < 2)
+        return;
+    int size = sizeof(*z_vals) * x_count * y_count;
+    bm->z_vals = malloc(size);
+    memcpy(bm->z_vals, z_vals, size);
+    bm->x_count = x_count;
+    bm->y_count = y_count;
+    bm->min_x = min_x;
+    bm->min_y = min_y;
+    bm->x_dist = x_dist;
+    bm->y_dist = y_dist;
+}
+
+void __visible
+bedmesh_set_offsets(struct bedmesh *bm, double x_offset, double y_offset)
+{
+    bm->x_offset = x_offset;
+    bm->y_offset = y_offset;
+}
+
+static inline double
+constrain(double val, double min_val, double max_val)
+{
+    return val < min_val ? min_val : (val > max_val ? max_val : val);
+}
+
+static inline double
+lerp(double t, double v0, double v1)
+{
+    return (1. - t) * v0 + t * v1;
+}
+
+// Find the mesh cell containing a coordinate and the position within it
+static inline int
+get_linear_index(double coord, double mesh_min, int mesh_cnt, double mesh_dist
+                 , double *t)
+{
+    double fidx = constrain(floor((coord - mesh_min) / mesh_dist)
+                            , 0., mesh_cnt - 2);
+    int idx = fidx;
+    *t = constrain((coord - (mesh_min + mesh_dist * idx)) / mesh_dist, 0., 1.);
+    return idx;
+}
+
+// Return the z adjustment of the mesh at the given position
+double __visible
+bedmesh_calc_z(struct bedmesh *bm, double x, double y)
+{
+    if (!bm->z_vals)
+        // No mesh table generated, no z-adjustment
+        return 0.;
+    double tx, ty;
+    int xidx = get_linear_index(x + bm->x_offset, bm->min_x, bm->x_count
+                                , bm->x_dist, &tx);
+    int yidx = get_linear_index(y + bm->y_offset, bm->min_y, bm->y_count
+                                , bm->y_dist, &ty);
+    double *row0 = &bm->z_vals[yidx * bm->x_count + xidx];
+    double *row1 = row0 + bm->x_count;
+    double z0 = lerp(tx, row0[0], row0[1]);
+    double z1 = lerp(tx, row1[0], row1[1]);
+    return lerp(ty, z0, z1);
+}
+
+static inline double
+calc_z_offset(struct bedmesh *bm, double *pos, double z_factor
+              , double fade_offset)
+{
+    double z = bedmesh_calc_z(bm, pos[0], pos[1]);
+    return z_factor * (z - fade_offset) + fade_offset;
+}
+
+static inline void
+store_pos(double *out, int count, int max, double *pos, double z_offset)
+{
+    if (count >= max)
+        return;
+    double *p = &out[count * 4];
+    p[0] = pos[0];
+    p[1] = pos[1];
+    p[2] = pos[2] + z_offset;
+    p[3] = pos[3];
+}
+
+// Split a move into segments that follow the mesh.  The move is
+// checked every 'move_check_distance' and a new segment is started
+// whenever the z adjustment changes by 'split_delta_z'.  The end
+// position of each segment is stored in 'out' (x, y, z, e) and the
+// number of segments is returned - if that exceeds 'max' then only
+// the first 'max' segments are stored.
+int __visible
+bedmesh_split_move(struct bedmesh *bm, double *prev_pos, double *next_pos
+                   , double z_factor, double fade_offset
+                   , double move_check_distance, double split_delta_z
+                   , double *out, int max)
+{
+    double cur_pos[4], axes_d[4];
+    int axis_move[4], count = 0, i;
+    for (i=0; i<4; i++) {
+        cur_pos[i] = prev_pos[i];
+        axes_d[i] = next_pos[i] - prev_pos[i];
+        axis_move[i] = fabs(axes_d[i]) > 1e-10;
+    }
+    double z_offset = calc_z_offset(bm, prev_pos, z_factor, fade_offset);
+    if (axis_move[0] || axis_move[1]) {
+        // X and/or Y axis move, traverse if necessary
+        double total_move_length = sqrt(axes_d[0]*axes_d[0]
+                                        + axes_d[1]*axes_d[1]
+                                        + axes_d[2]*axes_d[2]);
+        double distance_checked = 0.;
+        while (distance_checked + move_check_distance < total_move_length) {
+            distance_checked += move_check_distance;
+            double t = distance_checked / total_move_length;
+            for (i=0; i<4; i++)
+                if (axis_move[i])
+                    cur_pos[i] = lerp(t, prev_pos[i], next_pos[i]);
+            double next_z = calc_z_offset(bm, cur_pos, z_factor, fade_offset);
+            if (fabs(next_z - z_offset) >= split_delta_z) {
+                z_offset = next_z;
+                store_pos(out, count++, max, cur_pos, z_offset);
+            }
+        }
+    }
+    // end of move reached
+    z_offset = calc_z_offset(bm, next_pos, z_factor, fade_offset);
+    store_pos(out, count++, max, next_pos, z_offset);
+    return count;
+}
+
+// Points considered while splitting a move on the mesh grid
+struct split_points {
+    struct split_point { double t, z; } *pts;
+    int count, size;
+};
+
+static void
+add_split_point(struct split_points *sp, double t, double z)
+{
+    if (sp->count >= sp->size) {
+        sp->size = sp->size ? sp->size * 2 : 16;
+        sp->pts = realloc(sp->pts, sizeof(*sp->pts) * sp->size);
+    }
+    sp->pts[sp->count].t = t;
+    sp->pts[sp->count].z = z;
+    sp->count++;
+}
+
+// Add the positions (0 < t < 1) where a move crosses the grid lines of
+// an axis
+static void
+add_grid_crossings(double *ts, int *count, double start, double dist
+                   , double mesh_min, double mesh_dist, int mesh_cnt)
+{
+    int i;
+    for (i=0; i<mesh_cnt; i++) {
+        double t = (mesh_min + mesh_dist * i - start) / dist;
+        if (t > 0. && t < 1.)
+            ts[(*count)++] = t;
+    }
+}
+
+static int
+cmp_double(const void *a, const void *b)
+{
+    double da = *(const double *)a, db = *(const double *)b;
+    return da < db ? -1 : (da > db ? 1 : 0);
+}
+
+static inline void
+calc_split_pos(double *pos, double *prev_pos, double *next_pos
+               , int *axis_move, double t)
+{
+    int i;
+    for (i=0; i<4; i++)
+        pos[i] = axis_move[i] ? lerp(t, prev_pos[i], next_pos[i]) : prev_pos[i];
+}
+
+// Add a candidate split point, emitting the previous candidate if the
+// pending segment can not be extended to the new point
+static int
+add_split_candidate(struct split_points *sp, double t, double z, double tol
+                    , double *out, int count, int max, double *prev_pos
+                    , double *next_pos, int *axis_move)
+{
+    struct split_point *first = &sp->pts[0];
+    int i;
+    for (i=1; i<sp->count; i++) {
+        struct split_point *p = &sp->pts[i];
+        double chord_z = (first->z + (z - first->z) * (p->t - first->t)
+                          / (t - first->t));
+        if (fabs(p->z - chord_z) > tol)
+            break;
+    }
+    if (i < sp->count) {
+        // Emit the previous candidate and start a new segment there
+        struct split_point last = sp->pts[sp->count - 1];
+        double pos[4];
+        calc_split_pos(pos, prev_pos, next_pos, axis_move, last.t);
+        store_pos(out, count++, max, pos, last.z);
+        sp->pts[0] = last;
+        sp->count = 1;
+    }
+    add_split_point(sp, t, z);
+    return count;
+}
+
+// Split a move where it crosses the grid lines of the mesh.  Within a
+// mesh cell the z adjustment along the move is a quadratic, so cell
+// segments are further divided until the maximum deviation from the
+// curve is within 'split_delta_z' / 2.  Neighboring segments are then
+// merged as long as the merged segment stays within that tolerance at
+// every candidate point.  The result is stored in 'out' (as in
+// bedmesh_split_move) and the number of segments is returned.
+int __visible
+bedmesh_split_move_grid(struct bedmesh *bm, double *prev_pos
+                        , double *next_pos, double z_factor
+                        , double fade_offset, double split_delta_z
+                        , double *out, int max)
+{
+    double axes_d[4], pos[4];
+    int axis_move[4], count = 0, i, j;
+    for (i=0; i<4; i++) {
+        axes_d[i] = next_pos[i] - prev_pos[i];
+        axis_move[i] = fabs(axes_d[i]) > 1e-10;
+    }
+    double end_z = calc_z_offset(bm, next_pos, z_factor, fade_offset);
+    if (!bm->z_vals || !(axis_move[0] || axis_move[1])) {
+        store_pos(out, count++, max, next_pos, end_z);
+        return count;
+    }
+    // Find the cell boundaries along the move
+    double *ts = malloc(sizeof(*ts) * (bm->x_count + bm->y_count + 2));
+    int ts_count = 0;
+    if (axis_move[0])
+        add_grid_crossings(ts, &ts_count, prev_pos[0], axes_d[0]
+                           , bm->min_x - bm->x_offset, bm->x_dist
+                           , bm->x_count);
+    if (axis_move[1])
+        add_grid_crossings(ts, &ts_count, prev_pos[1], axes_d[1]
+                           , bm->min_y - bm->y_offset, bm->y_dist
+                           , bm->y_count);
+    qsort(ts, ts_count, sizeof(*ts), cmp_double);
+    ts[ts_count++] = 1.;
+
+    double tol = .5 * split_delta_z, start_t = 0.;
+    double start_z = calc_z_offset(bm, prev_pos, z_factor, fade_offset);
+    struct split_points sp = { NULL, 0, 0 };
+    add_split_point(&sp, start_t, start_z);
+    for (i=0; i<ts_count; i++) {
+        double end_t = ts[i], seg_t = end_t - start_t, seg_z = end_z;
+        if (seg_t < 1e-9 && i < ts_count - 1)
+            continue;
+        if (i < ts_count - 1) {
+            calc_split_pos(pos, prev_pos, next_pos, axis_move, end_t);
+            seg_z = calc_z_offset(bm, pos, z_factor, fade_offset);
+        }
+        // Divide the cell segment based on its curvature
+        calc_split_pos(pos, prev_pos, next_pos, axis_move
+                       , start_t + .5 * seg_t);
+        double mid_z = calc_z_offset(bm, pos, z_factor, fade_offset);
+        double dev = .5 * fabs(start_z + seg_z - 2. * mid_z);
+        int parts = dev > tol ? (int)ceil(sqrt(dev / tol)) : 1;
+        for (j=1; j<parts; j++) {
+            double t = start_t + seg_t * j / parts;
+            calc_split_pos(pos, prev_pos, next_pos, axis_move, t);
+            double z = calc_z_offset(bm, pos, z_factor, fade_offset);
+            count = add_split_candidate(&sp, t, z, tol, out, count, max
+                                        , prev_pos, next_pos, axis_move);
+        }
+        count = add_split_candidate(&sp, end_t, seg_z, tol, out, count, max
+                                    , prev_pos, next_pos, axis_move);
+        start_t = end_t;
+        start_z = seg_z;
+    }
+    free(sp.pts);
+    free(ts);
+    // end of move reached
+    store_pos(out, count++, max, next_pos, end_z);
+    return count;
+}
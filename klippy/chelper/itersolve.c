@@ -4,7 +4,7 @@
 //
 // This file may be distributed under the terms of the GNU GPLv3 license.
 
-#include <math.h> // fabs
+#include <math.h> // fabs, sqrt
 #include <stddef.h> // offsetof
 #include <string.h> // memset
 #include "compiler.h" // __visible
@@ -24,11 +24,21 @@ struct timepos {
 
 #define SEEK_TIME_RESET 0.000100
 
+static int32_t linear_gen_steps_range(
+    struct stepper_kinematics *sk, struct move *m, double base, double ratio
+    , double abs_start, double abs_end);
+
 // Generate step times for a portion of a move
 static int32_t
 itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
                           , double abs_start, double abs_end)
 {
+    if (sk->calc_linear_cb && !sk->disable_linear) {
+        double base, ratio;
+        if (!sk->calc_linear_cb(sk, m, &base, &ratio))
+            return linear_gen_steps_range(sk, m, base, ratio
+                                          , abs_start, abs_end);
+    }
     sk_calc_callback calc_position_cb = sk->calc_position_cb;
     double half_step = .5 * sk->step_dist;
     double start = abs_start - m->print_time, end = abs_end - m->print_time;
@@ -128,6 +138,100 @@ itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
 }
 
 
+/****************************************************************
+ * Closed form solver for linear kinematics
+ ****************************************************************/
+
+// Kinematics may report (via calc_linear_cb) that the stepper
+// position during a move is a linear function of the move distance:
+//   position(t) = base + ratio * move_get_distance(m, t)
+// The stepper position is then a quadratic of time and the step
+// times can be calculated directly instead of searched for.
+
+// Find the time that 'a*t^2 + b*t + c' reaches zero while the
+// quadratic is increasing (sdir=1) or decreasing (sdir=0)
+static double
+find_quadratic_root(double a, double b, double c, int sdir
+                    , double start, double end)
+{
+    double t;
+    if (!a) {
+        t = -c / b;
+    } else {
+        double disc = b*b - 4.*a*c;
+        double sq = disc > 0. ? sqrt(disc) : 0., s = sdir ? sq : -sq;
+        // Select the calculation that avoids subtracting similar values
+        double den = -b - s;
+        if ((b > 0.) == sdir && den)
+            t = 2. * c / den;
+        else
+            t = (s - b) / (2. * a);
+    }
+    if (!(t > start)) // or NaN
+        return start;
+    if (t > end)
+        return end;
+    return t;
+}
+
+// Generate step times for a portion of a move using the closed form
+static int32_t
+linear_gen_steps_range(struct stepper_kinematics *sk, struct move *m
+                       , double base, double ratio
+                       , double abs_start, double abs_end)
+{
+    double start = abs_start - m->print_time, end = abs_end - m->print_time;
+    if (start < 0.)
+        start = 0.;
+    if (end > m->move_t)
+        end = m->move_t;
+    double a = ratio * m->half_accel, b = ratio * m->start_v;
+    double step_dist = sk->step_dist, half_step = .5 * step_dist;
+    double pos = sk->commanded_pos;
+    // Split the range at the time the stepper changes direction
+    double times[3] = { start, end, end };
+    int count = 1, i;
+    if (a) {
+        double dir_change_time = -.5 * b / a;
+        if (dir_change_time > start && dir_change_time < end) {
+            times[1] = dir_change_time;
+            count = 2;
+        }
+    }
+    for (i=0; i<count; i++) {
+        double range_start = times[i], range_end = times[i+1];
+        double velocity = 2. * a * (.5 * (range_start + range_end)) + b;
+        if (!velocity || range_end <= range_start)
+            continue;
+        int sdir = velocity > 0.;
+        double end_pos = base + (b + a * range_end) * range_end;
+        for (;;) {
+            double target = sdir ? pos + half_step : pos - half_step;
+            double dist = sdir ? end_pos - target : target - end_pos;
+            if (dist < -.000000001)
+                break;
+            double step_time = find_quadratic_root(
+                a, b, base - target, sdir, range_start, range_end);
+            int ret = stepcompress_append(sk->sc, sdir, m->print_time
+                                          , step_time);
+            if (ret)
+                return ret;
+            pos = sdir ? pos + step_dist : pos - step_dist;
+        }
+        if ((sdir ? end_pos - pos : pos - end_pos) >= 0.) {
+            // Avoid rollback if stepper fully reaches step position
+            int ret = stepcompress_commit(sk->sc);
+            if (ret)
+                return ret;
+        }
+    }
+    sk->commanded_pos = pos;
+    if (sk->post_cb)
+        sk->post_cb(sk);
+    return 0;
+}
+
+
 /****************************************************************
  * Interface functions
  ****************************************************************/
@@ -278,3 +382,11 @@ itersolve_get_commanded_pos(struct stepper_kinematics *sk)
 {
     return sk->commanded_pos;
 }
+
+// Enable or disable the closed form solver (when the kinematics
+// supports it) - mainly useful for testing and benchmarking
+void __visible
+itersolve_set_linear_solver(struct stepper_kinematics *sk, int enable)
+{
+    sk->disable_linear = !enable;
+}
@@ -12,16 +12,19 @@ struct move;
 typedef double (*sk_calc_callback)(struct stepper_kinematics *sk, struct move *m
                                    , double move_time);
 typedef void (*sk_post_callback)(struct stepper_kinematics *sk);
+typedef int (*sk_linear_callback)(struct stepper_kinematics *sk, struct move *m
+                                  , double *base, double *ratio);
 struct stepper_kinematics {
     double step_dist, commanded_pos;
     struct stepcompress *sc;
 
     double last_flush_time, last_move_time;
     struct trapq *tq;
-    int active_flags;
+    int active_flags, disable_linear;
     double gen_steps_pre_active, gen_steps_post_active;
 
     sk_calc_callback calc_position_cb;
+    sk_linear_callback calc_linear_cb;
     sk_post_callback post_cb;
 };
 
@@ -37,5 +40,6 @@ double itersolve_calc_position_from_coord(struct stepper_kinematics *sk
 void itersolve_set_position(struct stepper_kinematics *sk
                             , double x, double y, double z);
 double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+void itersolve_set_linear_solver(struct stepper_kinematics *sk, int enable);
 
 #endif // itersolve.h
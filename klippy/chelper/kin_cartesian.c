@@ -18,6 +18,15 @@ cart_stepper_x_calc_position(struct stepper_kinematics *sk, struct move *m
     return move_get_coord(m, move_time).x;
 }
 
+static int
+cart_stepper_x_calc_linear(struct stepper_kinematics *sk, struct move *m
+                           , double *base, double *ratio)
+{
+    *base = m->start_pos.x;
+    *ratio = m->axes_r.x;
+    return 0;
+}
+
 static double
 cart_stepper_y_calc_position(struct stepper_kinematics *sk, struct move *m
                              , double move_time)
@@ -25,6 +34,15 @@ cart_stepper_y_calc_position(struct stepper_kinematics *sk, struct move *m
     return move_get_coord(m, move_time).y;
 }
 
+static int
+cart_stepper_y_calc_linear(struct stepper_kinematics *sk, struct move *m
+                           , double *base, double *ratio)
+{
+    *base = m->start_pos.y;
+    *ratio = m->axes_r.y;
+    return 0;
+}
+
 static double
 cart_stepper_z_calc_position(struct stepper_kinematics *sk, struct move *m
                              , double move_time)
@@ -32,6 +50,15 @@ cart_stepper_z_calc_position(struct stepper_kinematics *sk, struct move *m
     return move_get_coord(m, move_time).z;
 }
 
+static int
+cart_stepper_z_calc_linear(struct stepper_kinematics *sk, struct move *m
+                           , double *base, double *ratio)
+{
+    *base = m->start_pos.z;
+    *ratio = m->axes_r.z;
+    return 0;
+}
+
 struct stepper_kinematics * __visible
 cartesian_stepper_alloc(char axis)
 {
@@ -39,12 +66,15 @@ cartesian_stepper_alloc(char axis)
     memset(sk, 0, sizeof(*sk));
     if (axis == 'x') {
         sk->calc_position_cb = cart_stepper_x_calc_position;
+        sk->calc_linear_cb = cart_stepper_x_calc_linear;
         sk->active_flags = AF_X;
     } else if (axis == 'y') {
         sk->calc_position_cb = cart_stepper_y_calc_position;
+        sk->calc_linear_cb = cart_stepper_y_calc_linear;
         sk->active_flags = AF_Y;
     } else if (axis == 'z') {
         sk->calc_position_cb = cart_stepper_z_calc_position;
+        sk->calc_linear_cb = cart_stepper_z_calc_linear;
         sk->active_flags = AF_Z;
     }
     return sk;
@@ -57,6 +87,16 @@ cart_reverse_stepper_x_calc_position(struct stepper_kinematics *sk
     return -move_get_coord(m, move_time).x;
 }
 
+static int
+cart_reverse_stepper_x_calc_linear(struct stepper_kinematics *sk
+                                   , struct move *m, double *base
+                                   , double *ratio)
+{
+    *base = -m->start_pos.x;
+    *ratio = -m->axes_r.x;
+    return 0;
+}
+
 static double
 cart_reverse_stepper_y_calc_position(struct stepper_kinematics *sk
                              , struct move *m, double move_time)
@@ -64,6 +104,16 @@ cart_reverse_stepper_y_calc_position(struct stepper_kinematics *sk
     return -move_get_coord(m, move_time).y;
 }
 
+static int
+cart_reverse_stepper_y_calc_linear(struct stepper_kinematics *sk
+                                   , struct move *m, double *base
+                                   , double *ratio)
+{
+    *base = -m->start_pos.y;
+    *ratio = -m->axes_r.y;
+    return 0;
+}
+
 static double
 cart_reverse_stepper_z_calc_position(struct stepper_kinematics *sk
                              , struct move *m, double move_time)
@@ -71,6 +121,16 @@ cart_reverse_stepper_z_calc_position(struct stepper_kinematics *sk
     return -move_get_coord(m, move_time).z;
 }
 
+static int
+cart_reverse_stepper_z_calc_linear(struct stepper_kinematics *sk
+                                   , struct move *m, double *base
+                                   , double *ratio)
+{
+    *base = -m->start_pos.z;
+    *ratio = -m->axes_r.z;
+    return 0;
+}
+
 struct stepper_kinematics * __visible
 cartesian_reverse_stepper_alloc(char axis)
 {
@@ -78,12 +138,15 @@ cartesian_reverse_stepper_alloc(char axis)
     memset(sk, 0, sizeof(*sk));
     if (axis == 'x') {
         sk->calc_position_cb = cart_reverse_stepper_x_calc_position;
+        sk->calc_linear_cb = cart_reverse_stepper_x_calc_linear;
         sk->active_flags = AF_X;
     } else if (axis == 'y') {
         sk->calc_position_cb = cart_reverse_stepper_y_calc_position;
+        sk->calc_linear_cb = cart_reverse_stepper_y_calc_linear;
         sk->active_flags = AF_Y;
     } else if (axis == 'z') {
         sk->calc_position_cb = cart_reverse_stepper_z_calc_position;
+        sk->calc_linear_cb = cart_reverse_stepper_z_calc_linear;
         sk->active_flags = AF_Z;
     }
     return sk;
@@ -18,6 +18,15 @@ corexy_stepper_plus_calc_position(struct stepper_kinematics *sk, struct move *m
     return c.x + c.y;
 }
 
+static int
+corexy_stepper_plus_calc_linear(struct stepper_kinematics *sk, struct move *m
+                                , double *base, double *ratio)
+{
+    *base = m->start_pos.x + m->start_pos.y;
+    *ratio = m->axes_r.x + m->axes_r.y;
+    return 0;
+}
+
 static double
 corexy_stepper_minus_calc_position(struct stepper_kinematics *sk, struct move *m
                                    , double move_time)
@@ -26,15 +35,27 @@ corexy_stepper_minus_calc_position(struct stepper_kinematics *sk, struct move *m
     return c.x - c.y;
 }
 
+static int
+corexy_stepper_minus_calc_linear(struct stepper_kinematics *sk, struct move *m
+                                 , double *base, double *ratio)
+{
+    *base = m->start_pos.x - m->start_pos.y;
+    *ratio = m->axes_r.x - m->axes_r.y;
+    return 0;
+}
+
 struct stepper_kinematics * __visible
 corexy_stepper_alloc(char type)
 {
     struct stepper_kinematics *sk = malloc(sizeof(*sk));
     memset(sk, 0, sizeof(*sk));
-    if (type == '+')
+    if (type == '+') {
         sk->calc_position_cb = corexy_stepper_plus_calc_position;
-    else if (type == '-')
+        sk->calc_linear_cb = corexy_stepper_plus_calc_linear;
+    } else if (type == '-') {
         sk->calc_position_cb = corexy_stepper_minus_calc_position;
+        sk->calc_linear_cb = corexy_stepper_minus_calc_linear;
+    }
     sk->active_flags = AF_X | AF_Y;
     return sk;
 }
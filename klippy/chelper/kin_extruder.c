@@ -120,6 +120,19 @@ extruder_calc_position(struct stepper_kinematics *sk, struct move *m
     return m->start_pos.x + area * es->inv_half_smooth_time2;
 }
 
+static int
+extruder_calc_linear(struct stepper_kinematics *sk, struct move *m
+                     , double *base, double *ratio)
+{
+    struct extruder_stepper *es = container_of(sk, struct extruder_stepper, sk);
+    if (es->half_smooth_time)
+        // Pressure advance is not linear - use the iterative solver
+        return -1;
+    *base = m->start_pos.x;
+    *ratio = 1.;
+    return 0;
+}
+
 void __visible
 extruder_set_pressure_advance(struct stepper_kinematics *sk
                               , double pressure_advance, double smooth_time)
@@ -140,6 +153,7 @@ extruder_stepper_alloc(void)
     struct extruder_stepper *es = malloc(sizeof(*es));
     memset(es, 0, sizeof(*es));
     es->sk.calc_position_cb = extruder_calc_position;
+    es->sk.calc_linear_cb = extruder_calc_linear;
     es->sk.active_flags = AF_X;
     return &es->sk;
 }
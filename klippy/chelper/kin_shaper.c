@@ -5,7 +5,7 @@
 //
 // This file may be distributed under the terms of the GNU GPLv3 license.
 
-#include <math.h> // sqrt, exp
+#include <math.h> // HUGE_VAL
 #include <stddef.h> // offsetof
 #include <stdlib.h> // malloc
 #include <string.h> // memset
@@ -74,17 +74,25 @@ get_axis_position(struct move *m, int axis, double move_time)
     return start_pos + axis_r * move_dist;
 }
 
-static inline double
-get_axis_position_across_moves(struct move *m, int axis, double time)
+// Find the move (and the time relative to it) at a time relative to 'm'
+static inline struct move *
+find_move_across_moves(struct move *m, double *time)
 {
-    while (likely(time < 0.)) {
+    while (likely(*time < 0.)) {
         m = list_prev_entry(m, node);
-        time += m->move_t;
+        *time += m->move_t;
     }
-    while (likely(time > m->move_t)) {
-        time -= m->move_t;
+    while (likely(*time > m->move_t)) {
+        *time -= m->move_t;
         m = list_next_entry(m, node);
     }
+    return m;
+}
+
+static inline double
+get_axis_position_across_moves(struct move *m, int axis, double time)
+{
+    m = find_move_across_moves(m, &time);
     return get_axis_position(m, axis, time);
 }
 
@@ -103,6 +111,67 @@ calc_position(struct move *m, int axis, double move_time
 }
 
 
+/****************************************************************
+ * Shaped trajectory segments
+ ****************************************************************/
+
+// While none of the shaper pulses cross a move boundary, the shaped
+// position is a weighted sum of quadratics and thus itself a quadratic
+// of time.  The pulse weights are combined into that quadratic once
+// per segment so that each step time guess only evaluates a polynomial.
+
+struct shaper_segment {
+    struct move *m;
+    double start, end, t0;
+    double c0, c1, c2;
+};
+
+// Calculate the shaped trajectory segment of an axis around 'move_time'
+static void
+calc_segment(struct move *m, int axis, double move_time
+             , struct shaper_pulses *sp, struct shaper_segment *seg)
+{
+    double start = -HUGE_VAL, end = HUGE_VAL, c0 = 0., c1 = 0., c2 = 0.;
+    int num_pulses = sp->num_pulses, i;
+    for (i = 0; i < num_pulses; ++i) {
+        double t = move_time + sp->pulses[i].t, a = sp->pulses[i].a;
+        struct move *pm = find_move_across_moves(m, &t);
+        double axis_r = pm->axes_r.axis[axis - 'x'];
+        double start_pos = pm->start_pos.axis[axis - 'x'];
+        double v = axis_r * pm->start_v, ha = axis_r * pm->half_accel;
+        c0 += a * (start_pos + (v + ha * t) * t);
+        c1 += a * (v + 2. * ha * t);
+        c2 += a * ha;
+        // The segment is valid while this pulse remains in move 'pm'
+        if (move_time - t > start)
+            start = move_time - t;
+        if (move_time + pm->move_t - t < end)
+            end = move_time + pm->move_t - t;
+    }
+    seg->m = m;
+    seg->start = start;
+    seg->end = end;
+    seg->t0 = move_time;
+    seg->c0 = c0;
+    seg->c1 = c1;
+    seg->c2 = c2;
+}
+
+// Calculate the shaped position using the cached trajectory segment
+static inline double
+calc_segment_position(struct move *m, int axis, double move_time
+                      , struct shaper_pulses *sp, struct shaper_segment *seg)
+{
+    if (unlikely(!m->node.next))
+        // Not a move on a trapq (eg, from itersolve_set_position())
+        return calc_position(m, axis, move_time, sp);
+    if (seg->m != m || move_time < seg->start || move_time > seg->end)
+        calc_segment(m, axis, move_time, sp, seg);
+    double dt = move_time - seg->t0;
+    return seg->c0 + (seg->c1 + seg->c2 * dt) * dt;
+}
+
+
 /****************************************************************
  * Kinematics-related shaper code
  ****************************************************************/
@@ -114,6 +183,7 @@ struct input_shaper {
     struct stepper_kinematics *orig_sk;
     struct move m;
     struct shaper_pulses sx, sy;
+    struct shaper_segment segx, segy;
 };
 
 // Optimized calc_position when only x axis is needed
@@ -124,7 +194,8 @@ shaper_x_calc_position(struct stepper_kinematics *sk, struct move *m
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
     if (!is->sx.num_pulses)
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
-    is->m.start_pos.x = calc_position(m, 'x', move_time, &is->sx);
+    is->m.start_pos.x = calc_segment_position(m, 'x', move_time
+                                               , &is->sx, &is->segx);
     return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
 }
 
@@ -136,7 +207,8 @@ shaper_y_calc_position(struct stepper_kinematics *sk, struct move *m
     struct input_shaper *is = container_of(sk, struct input_shaper, sk);
     if (!is->sy.num_pulses)
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
-    is->m.start_pos.y = calc_position(m, 'y', move_time, &is->sy);
+    is->m.start_pos.y = calc_segment_position(m, 'y', move_time
+                                               , &is->sy, &is->segy);
     return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
 }
 
@@ -150,12 +222,23 @@ shaper_xy_calc_position(struct stepper_kinematics *sk, struct move *m
         return is->orig_sk->calc_position_cb(is->orig_sk, m, move_time);
     is->m.start_pos = move_get_coord(m, move_time);
     if (is->sx.num_pulses)
-        is->m.start_pos.x = calc_position(m, 'x', move_time, &is->sx);
+        is->m.start_pos.x = calc_segment_position(m, 'x', move_time
+                                                   , &is->sx, &is->segx);
     if (is->sy.num_pulses)
-        is->m.start_pos.y = calc_position(m, 'y', move_time, &is->sy);
+        is->m.start_pos.y = calc_segment_position(m, 'y', move_time
+                                                   , &is->sy, &is->segy);
     return is->orig_sk->calc_position_cb(is->orig_sk, &is->m, DUMMY_T);
 }
 
+// Trajectory segments are only valid while the trapq is unchanged, so
+// discard them after each step generation range
+static void
+shaper_post_fixup(struct stepper_kinematics *sk)
+{
+    struct input_shaper *is = container_of(sk, struct input_shaper, sk);
+    is->segx.m = is->segy.m = NULL;
+}
+
 int __visible
 input_shaper_set_sk(struct stepper_kinematics *sk
                     , struct stepper_kinematics *orig_sk)
@@ -206,6 +289,7 @@ input_shaper_set_shaper_params(struct stepper_kinematics *sk, char axis
     else
         sp->num_pulses = 0;
     shaper_note_generation_time(is);
+    is->segx.m = is->segy.m = NULL;
     return status;
 }
 
@@ -228,5 +312,6 @@ input_shaper_alloc(void)
     struct input_shaper *is = malloc(sizeof(*is));
     memset(is, 0, sizeof(*is));
     is->m.move_t = 2. * DUMMY_T;
+    is->sk.post_cb = shaper_post_fixup;
     return &is->sk;
 }
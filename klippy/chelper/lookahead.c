@@ -0,0 +1,103 @@
+// Move queue "look-ahead" junction velocity planning
+//
+// Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // malloc
+#include "compiler.h" // __visible
+
+// Junction limits of a queued move (as calculated by Move.calc_junction)
+struct lookahead_move {
+    double max_start_v2, max_cruise_v2, delta_v2;
+    double max_smoothed_v2, smooth_delta_v2;
+};
+
+// Junction velocities chosen for a queued move
+struct lookahead_junction {
+    double start_v2, cruise_v2, end_v2;
+};
+
+static inline double
+min2(double a, double b)
+{
+    return a < b ? a : b;
+}
+
+static inline void
+set_junction(struct lookahead_junction *j, double start_v2, double cruise_v2
+             , double end_v2)
+{
+    j->start_v2 = start_v2;
+    j->cruise_v2 = cruise_v2;
+    j->end_v2 = end_v2;
+}
+
+// Determine the junction velocities of a list of queued moves.  This
+// is a port of the python MoveQueue.flush() code - the moves are
+// traversed from last to first assuming the robot comes to a complete
+// stop after the last move.  Returns the number of moves that may be
+// flushed (or 0 if a lazy flush found no moves ready to be flushed).
+int __visible
+lookahead_flush(struct lookahead_move *moves
+                , struct lookahead_junction *junctions, int count, int lazy)
+{
+    int update_flush_count = lazy, flush_count = count, delayed = 0, i, j;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    double *start_v2s = malloc(sizeof(*start_v2s) * (count + 1));
+    start_v2s[count] = 0.;
+    for (i=count-1; i>=0; i--) {
+        struct lookahead_move *m = &moves[i];
+        double reachable_start_v2 = next_end_v2 + m->delta_v2;
+        double start_v2 = min2(m->max_start_v2, reachable_start_v2);
+        double reachable_smoothed_v2 = next_smoothed_v2 + m->smooth_delta_v2;
+        double smoothed_v2 = min2(m->max_smoothed_v2, reachable_smoothed_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + m->smooth_delta_v2 > next_smoothed_v2
+                || delayed) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = min2(m->max_cruise_v2, (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (delayed) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    // (delayed moves are always the ones directly
+                    // after this move in the queue)
+                    if (!update_flush_count && i < flush_count) {
+                        double mc_v2 = peak_cruise_v2;
+                        for (j=i+1; j<=i+delayed; j++) {
+                            double ms_v2 = start_v2s[j];
+                            double me_v2 = start_v2s[j+1];
+                            mc_v2 = min2(mc_v2, ms_v2);
+                            set_junction(&junctions[j], min2(ms_v2, mc_v2)
+                                         , mc_v2, min2(me_v2, mc_v2));
+                        }
+                    }
+                    delayed = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = min2(min2(
+                    (start_v2 + reachable_start_v2) * .5, m->max_cruise_v2)
+                                        , peak_cruise_v2);
+                set_junction(&junctions[i], min2(start_v2, cruise_v2)
+                             , cruise_v2, min2(next_end_v2, cruise_v2));
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            delayed++;
+        }
+        start_v2s[i] = start_v2;
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    free(start_v2s);
+    if (update_flush_count)
+        return 0;
+    return flush_count;
+}
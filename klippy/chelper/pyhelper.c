@@ -92,3 +92,19 @@ dump_string(char *outbuf, int outbuf_size, char *inbuf, int inbuf_size)
     *o = '\0';
     return outbuf;
 }
+
+// Copy data into a memory region protected by a sequence lock.  The
+// 32bit sequence counter at 'seq_offset' is odd while the data is
+// being updated, so that readers (in other processes) can detect and
+// retry a read that overlapped an update.
+void __visible
+seqlock_write(char *base, int seq_offset, int data_offset
+              , char *data, int len)
+{
+    uint32_t *seq = (void*)&base[seq_offset];
+    uint32_t s = __atomic_load_n(seq, __ATOMIC_RELAXED);
+    __atomic_store_n(seq, s + 1, __ATOMIC_RELAXED);
+    __atomic_thread_fence(__ATOMIC_RELEASE);
+    memcpy(&base[data_offset], data, len);
+    __atomic_store_n(seq, s + 2, __ATOMIC_RELEASE);
+}
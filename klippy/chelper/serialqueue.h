@@ -41,6 +41,8 @@ void serialqueue_send_one(struct serialqueue *sq, struct command_queue *cq
 void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
                       , uint8_t *msg, int len, uint64_t min_clock
                       , uint64_t req_clock, uint64_t notify_id);
+int serialqueue_pull_batch(struct serialqueue *sq
+                           , struct pull_queue_message *q, int max);
 void serialqueue_pull(struct serialqueue *sq, struct pull_queue_message *pqm);
 void serialqueue_set_wire_frequency(struct serialqueue *sq, double frequency);
 void serialqueue_set_receive_window(struct serialqueue *sq, int receive_window);
@@ -548,6 +548,17 @@ stepcompress_flush(struct stepcompress *sc, uint64_t move_clock)
     return queue_flush(sc, move_clock);
 }
 
+// Flush pending steps prior to the given print_time (the mcu clock is
+// calculated using the last steppersync_set_time() parameters)
+int
+stepcompress_flush_print_time(struct stepcompress *sc, double print_time)
+{
+    double clock = (print_time - sc->mcu_time_offset) * sc->mcu_freq;
+    if (clock < 0.)
+        return 0;
+    return stepcompress_flush(sc, (uint64_t)clock);
+}
+
 // Reset the internal state of the stepcompress object
 int __visible
 stepcompress_reset(struct stepcompress *sc, uint64_t last_step_clock)
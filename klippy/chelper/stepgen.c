@@ -0,0 +1,167 @@
+// Generate steps for multiple steppers using a pool of worker threads
+//
+// Copyright (C) 2026  Klipper contributors
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <pthread.h> // pthread_mutex_lock
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // itersolve_generate_steps
+#include "pyhelper.h" // report_errno
+#include "stepcompress.h" // stepcompress_flush_print_time
+#include "trapq.h" // trapq_check_sentinels
+
+struct stepgen {
+    pthread_mutex_t lock; // protects variables below
+    pthread_cond_t work_cond, done_cond;
+    pthread_t *threads;
+    int num_threads, shutdown;
+    // Current batch of steppers
+    struct stepper_kinematics **sks;
+    int32_t *results;
+    int count, next_index, pending;
+    double flush_time, compress_time;
+};
+
+// Generate the steps for a stepper and compress the steps that occur
+// prior to compress_time
+static int32_t
+generate_steps(struct stepper_kinematics *sk, double flush_time
+               , double compress_time)
+{
+    int32_t ret = itersolve_generate_steps(sk, flush_time);
+    if (ret || !sk->sc)
+        return ret;
+    return stepcompress_flush_print_time(sk->sc, compress_time);
+}
+
+// Generate steps for the steppers in the current batch until no
+// unclaimed steppers remain.  Must be called with the lock held.
+static void
+run_batch(struct stepgen *sg)
+{
+    while (sg->next_index < sg->count) {
+        int idx = sg->next_index++;
+        struct stepper_kinematics *sk = sg->sks[idx];
+        double flush_time = sg->flush_time, compress_time = sg->compress_time;
+        pthread_mutex_unlock(&sg->lock);
+        int32_t ret = generate_steps(sk, flush_time, compress_time);
+        pthread_mutex_lock(&sg->lock);
+        sg->results[idx] = ret;
+        if (!--sg->pending)
+            pthread_cond_signal(&sg->done_cond);
+    }
+}
+
+// Main code for each worker thread
+static void *
+worker_thread(void *data)
+{
+    struct stepgen *sg = data;
+    pthread_mutex_lock(&sg->lock);
+    for (;;) {
+        if (sg->shutdown)
+            break;
+        if (sg->next_index >= sg->count) {
+            pthread_cond_wait(&sg->work_cond, &sg->lock);
+            continue;
+        }
+        run_batch(sg);
+    }
+    pthread_mutex_unlock(&sg->lock);
+    return NULL;
+}
+
+// Create a step generation pool with the given number of threads
+// (the calling thread counts as one of the threads)
+struct stepgen * __visible
+stepgen_alloc(int num_threads)
+{
+    struct stepgen *sg = malloc(sizeof(*sg));
+    memset(sg, 0, sizeof(*sg));
+    pthread_mutex_init(&sg->lock, NULL);
+    pthread_cond_init(&sg->work_cond, NULL);
+    pthread_cond_init(&sg->done_cond, NULL);
+    if (num_threads > 1) {
+        sg->threads = malloc(sizeof(*sg->threads) * (num_threads - 1));
+        int i;
+        for (i=0; i<num_threads-1; i++) {
+            int ret = pthread_create(&sg->threads[i], NULL, worker_thread, sg);
+            if (ret) {
+                report_errno("pthread_create", ret);
+                break;
+            }
+            sg->num_threads++;
+        }
+    }
+    return sg;
+}
+
+// Stop the worker threads and free the pool
+void __visible
+stepgen_free(struct stepgen *sg)
+{
+    if (!sg)
+        return;
+    pthread_mutex_lock(&sg->lock);
+    sg->shutdown = 1;
+    pthread_cond_broadcast(&sg->work_cond);
+    pthread_mutex_unlock(&sg->lock);
+    int i;
+    for (i=0; i<sg->num_threads; i++)
+        pthread_join(sg->threads[i], NULL);
+    free(sg->threads);
+    free(sg->results);
+    pthread_cond_destroy(&sg->done_cond);
+    pthread_cond_destroy(&sg->work_cond);
+    pthread_mutex_destroy(&sg->lock);
+    free(sg);
+}
+
+// Generate steps for a list of steppers up to the given flush_time.
+// The steps prior to compress_time are also compressed into mcu
+// commands (as would be done by a later steppersync_flush() call).
+// Each stepper has its own stepcompress queue, so the results do not
+// depend on the order (or thread) in which the steppers are
+// processed.  Returns the first error (in list order) or zero on
+// success.
+int32_t __visible
+stepgen_generate_steps(struct stepgen *sg, struct stepper_kinematics **sks
+                       , int count, double flush_time, double compress_time)
+{
+    int i;
+    if (!sg->num_threads || count <= 1) {
+        for (i=0; i<count; i++) {
+            int32_t ret = generate_steps(sks[i], flush_time, compress_time);
+            if (ret)
+                return ret;
+        }
+        return 0;
+    }
+    // Steppers may share a trapq - update its sentinels before the
+    // threads start reading it
+    for (i=0; i<count; i++)
+        if (sks[i]->tq)
+            trapq_check_sentinels(sks[i]->tq);
+    // Start the batch and assist the worker threads
+    pthread_mutex_lock(&sg->lock);
+    sg->results = realloc(sg->results, sizeof(*sg->results) * count);
+    sg->sks = sks;
+    sg->flush_time = flush_time;
+    sg->compress_time = compress_time;
+    sg->count = sg->pending = count;
+    sg->next_index = 0;
+    pthread_cond_broadcast(&sg->work_cond);
+    run_batch(sg);
+    while (sg->pending)
+        pthread_cond_wait(&sg->done_cond, &sg->lock);
+    sg->sks = NULL;
+    sg->count = sg->next_index = 0;
+    pthread_mutex_unlock(&sg->lock);
+    for (i=0; i<count; i++)
+        if (sg->results[i])
+            return sg->results[i];
+    return 0;
+}
@@ -68,6 +68,19 @@ trapq_append(struct trapq *tq, double print_time
     }
 }
 
+// Add a batch of moves (stored as a flat array of doubles laid out
+// in the same order as the trapq_append() parameters) to the queue
+void __visible
+trapq_append_batch(struct trapq *tq, double *moves, int count)
+{
+    int i;
+    for (i=0; i<count; i++, moves += TRAPQ_APPEND_FIELDS)
+        trapq_append(tq, moves[0], moves[1], moves[2], moves[3]
+                     , moves[4], moves[5], moves[6]
+                     , moves[7], moves[8], moves[9]
+                     , moves[10], moves[11], moves[12]);
+}
+
 // Return the distance moved given a time in a move
 inline double
 move_get_distance(struct move *m, double move_time)
@@ -31,12 +31,16 @@ struct pull_move {
     double x_r, y_r, z_r;
 };
 
+// Number of doubles per move in trapq_append_batch()
+#define TRAPQ_APPEND_FIELDS 13
+
 struct move *move_alloc(void);
 void trapq_append(struct trapq *tq, double print_time
                   , double accel_t, double cruise_t, double decel_t
                   , double start_pos_x, double start_pos_y, double start_pos_z
                   , double axes_r_x, double axes_r_y, double axes_r_z
                   , double start_v, double cruise_v, double accel);
+void trapq_append_batch(struct trapq *tq, double *moves, int count);
 double move_get_distance(struct move *m, double move_time);
 struct coord move_get_coord(struct move *m, double move_time);
 struct trapq *trapq_alloc(void);
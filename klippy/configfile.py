@@ -10,6 +10,38 @@ error = configparser.Error
 class sentinel:
     pass
 
+# Read-only containers for status information.  These are handed out
+# by get_status() and may be shared by callers without being copied.
+class FrozenDict(dict):
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("'%s' object is read-only" % (type(self).__name__,))
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+    def __copy__(self):
+        return self
+    def __deepcopy__(self, memo):
+        return self
+
+class FrozenList(list):
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("'%s' object is read-only" % (type(self).__name__,))
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = _read_only
+    sort = reverse = _read_only
+    def __copy__(self):
+        return self
+    def __deepcopy__(self, memo):
+        return self
+
+def freeze_status(val):
+    if isinstance(val, dict):
+        return FrozenDict([(k, freeze_status(v)) for k, v in val.items()])
+    if isinstance(val, list):
+        return FrozenList([freeze_status(v) for v in val])
+    if type(val) is tuple:
+        return tuple([freeze_status(v) for v in val])
+    return val
+
 class ConfigWrapper:
     error = configparser.Error
     def __init__(self, printer, fileconfig, access_tracking, section):
@@ -139,11 +171,12 @@ class PrinterConfig:
         self.printer = printer
         self.autosave = None
         self.deprecated = {}
-        self.status_raw_config = {}
-        self.status_save_pending = {}
-        self.status_settings = {}
-        self.status_warnings = []
+        self.status_raw_config = FrozenDict()
+        self.status_save_pending = FrozenDict()
+        self.status_settings = FrozenDict()
+        self.status_warnings = FrozenList()
         self.save_config_pending = False
+        self.status_version = 0
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
                                desc=self.cmd_SAVE_CONFIG_help)
@@ -310,15 +343,18 @@ class PrinterConfig:
     def deprecate(self, section, option, value=None, msg=None):
         self.deprecated[(section, option, value)] = msg
     def _build_status(self, config):
-        self.status_raw_config.clear()
+        self.status_version += 1
+        raw_config = {}
         for section in config.get_prefix_sections(''):
-            self.status_raw_config[section.get_name()] = section_status = {}
+            raw_config[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
                 section_status[option] = section.get(option, note_valid=False)
-        self.status_settings = {}
+        self.status_raw_config = freeze_status(raw_config)
+        settings = {}
         for (section, option), value in config.access_tracking.items():
-            self.status_settings.setdefault(section, {})[option] = value
-        self.status_warnings = []
+            settings.setdefault(section, {})[option] = value
+        self.status_settings = freeze_status(settings)
+        warnings = []
         for (section, option, value), msg in self.deprecated.items():
             if value is None:
                 res = {'type': 'deprecated_option'}
@@ -327,13 +363,16 @@ class PrinterConfig:
             res['message'] = msg
             res['section'] = section
             res['option'] = option
-            self.status_warnings.append(res)
+            warnings.append(res)
+        self.status_warnings = freeze_status(warnings)
     def get_status(self, eventtime):
         return {'config': self.status_raw_config,
                 'settings': self.status_settings,
                 'warnings': self.status_warnings,
                 'save_config_pending': self.save_config_pending,
                 'save_config_pending_items': self.status_save_pending}
+    def get_status_version(self):
+        return self.status_version
     # Autosave functions
     def set(self, section, option, value):
         if not self.autosave.fileconfig.has_section(section):
@@ -346,22 +385,25 @@ class PrinterConfig:
         else:
             pending[section] = dict(pending[section])
         pending[section][option] = svalue
-        self.status_save_pending = pending
+        self.status_save_pending = freeze_status(pending)
         self.save_config_pending = True
+        self.status_version += 1
         logging.info("save_config: set [%s] %s = %s", section, option, svalue)
     def remove_section(self, section):
         if self.autosave.fileconfig.has_section(section):
             self.autosave.fileconfig.remove_section(section)
             pending = dict(self.status_save_pending)
             pending[section] = None
-            self.status_save_pending = pending
+            self.status_save_pending = freeze_status(pending)
             self.save_config_pending = True
+            self.status_version += 1
         elif (section in self.status_save_pending and
               self.status_save_pending[section] is not None):
             pending = dict(self.status_save_pending)
             del pending[section]
-            self.status_save_pending = pending
+            self.status_save_pending = freeze_status(pending)
             self.save_config_pending = True
+            self.status_version += 1
     def _disallow_include_conflicts(self, regular_data, cfgname, gcode):
         config = self._build_config_wrapper(regular_data, cfgname)
         for section in self.autosave.fileconfig.sections():
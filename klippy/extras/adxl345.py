@@ -5,6 +5,10 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, time, collections, threading, multiprocessing, os
 from . import bus, motion_report
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # ADXL345 registers
 REG_DEVID = 0x00
@@ -38,17 +42,39 @@ class AccelQueryHelper:
         print_time = printer.lookup_object('toolhead').get_last_move_time()
         self.request_start_time = self.request_end_time = print_time
         self.samples = self.raw_samples = []
+        self.is_finished = False
+        self.samples_callback = None
+        self.has_streamed_samples = False
     def finish_measurements(self):
         toolhead = self.printer.lookup_object('toolhead')
         self.request_end_time = toolhead.get_last_move_time()
+        self.is_finished = True
         toolhead.wait_moves()
         self.cconn.finalize()
+    def set_samples_callback(self, callback):
+        # Pass samples (as an array of (time, x, y, z) rows) to the
+        # callback as they arrive instead of storing them.  The samples
+        # are then not available from get_samples() or write_to_file().
+        self.samples_callback = callback
+        self.cconn.set_msg_callback(self._handle_msg)
+    def _handle_msg(self, msg):
+        data = numpy.asarray(msg['params']['data'], dtype=float).reshape(-1, 4)
+        times = data[:,0]
+        valid = times >= self.request_start_time
+        if self.is_finished:
+            valid &= times <= self.request_end_time
+        data = data[valid]
+        if len(data):
+            self.has_streamed_samples = True
+            self.samples_callback(data)
     def _get_raw_samples(self):
         raw_samples = self.cconn.get_messages()
         if raw_samples:
             self.raw_samples = raw_samples
         return self.raw_samples
     def has_valid_samples(self):
+        if self.samples_callback is not None:
+            return self.has_streamed_samples
         raw_samples = self._get_raw_samples()
         for msg in raw_samples:
             data = msg['params']['data']
@@ -70,6 +96,15 @@ class AccelQueryHelper:
         raw_samples = self._get_raw_samples()
         if not raw_samples:
             return self.samples
+        if numpy is not None:
+            # Return samples as an array of (time, x, y, z) rows
+            data = numpy.concatenate([
+                numpy.asarray(m['params']['data'], dtype=float).reshape(-1, 4)
+                for m in raw_samples])
+            times = data[:,0]
+            self.samples = data[(times >= self.request_start_time)
+                                & (times <= self.request_end_time)]
+            return self.samples
         total = sum([len(m['params']['data']) for m in raw_samples])
         count = 0
         self.samples = samples = [None] * total
@@ -92,7 +127,9 @@ class AccelQueryHelper:
                 pass
             f = open(filename, "w")
             f.write("#time,accel_x,accel_y,accel_z\n")
-            samples = self.samples or self.get_samples()
+            samples = self.samples
+            if not len(samples):
+                samples = self.get_samples()
             for t, accel_x, accel_y, accel_z in samples:
                 f.write("%.6f,%.6f,%.6f,%.6f\n" % (
                     t, accel_x, accel_y, accel_z))
@@ -157,7 +194,7 @@ class AccelCommandHelper:
         self.printer.lookup_object('toolhead').dwell(1.)
         aclient.finish_measurements()
         values = aclient.get_samples()
-        if not values:
+        if not len(values):
             raise gcmd.error("No accelerometer measurements found")
         _, accel_x, accel_y, accel_z = values[-1]
         gcmd.respond_info("accelerometer values (x, y, z): %.6f, %.6f, %.6f"
@@ -255,7 +292,8 @@ class ADXL345:
         mcu.add_config_cmd("query_adxl345 oid=%d clock=0 rest_ticks=0"
                            % (oid,), on_restart=True)
         mcu.register_config_callback(self._build_config)
-        mcu.register_response(self._handle_adxl345_data, "adxl345_data", oid)
+        mcu.register_batch_response(self._handle_adxl345_data, "adxl345_data",
+                                    oid)
         # Clock tracking
         self.last_sequence = self.max_query_duration = 0
         self.last_limit_count = self.last_error_count = 0
@@ -295,10 +333,12 @@ class ADXL345:
     # Measurement collection
     def is_measuring(self):
         return self.query_rate > 0
-    def _handle_adxl345_data(self, params):
+    def _handle_adxl345_data(self, msgs):
         with self.lock:
-            self.raw_samples.append(params)
+            self.raw_samples.extend(msgs)
     def _extract_samples(self, raw_samples):
+        if numpy is not None:
+            return self._extract_samples_array(raw_samples)
         # Load variables to optimize inner loop below
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
         last_sequence = self.last_sequence
@@ -332,6 +372,45 @@ class ADXL345:
         self.clock_sync.set_last_chip_clock(seq * SAMPLES_PER_BLOCK + i)
         del samples[count:]
         return samples
+    def _extract_samples_array(self, raw_samples):
+        # Decode all messages at once using numpy
+        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
+        last_sequence = self.last_sequence
+        time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
+        # Determine the sequence (and number of samples) of each message
+        seqs = numpy.array([params['sequence'] for params in raw_samples],
+                           dtype=numpy.int64)
+        seq_diff = (last_sequence - seqs) & 0xffff
+        seq_diff -= (seq_diff & 0x8000) << 1
+        seqs = last_sequence - seq_diff
+        datas = [params['data'] for params in raw_samples]
+        counts = numpy.array([len(d) // BYTES_PER_SAMPLE for d in datas])
+        data = b"".join([d[:c * BYTES_PER_SAMPLE]
+                         for d, c in zip(datas, counts)])
+        d = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int32)
+        xlow, ylow, zlow, xzhigh, yzhigh = d.reshape(-1, BYTES_PER_SAMPLE).T
+        # Determine the chip clock of each sample
+        msg_cdiff = numpy.repeat(seqs * SAMPLES_PER_BLOCK - chip_base, counts)
+        msg_index = numpy.arange(len(msg_cdiff)) - numpy.repeat(
+            numpy.cumsum(counts) - counts, counts)
+        # Discard samples with errors
+        valid = (yzhigh & 0x80) == 0
+        self.last_error_count += len(valid) - int(numpy.count_nonzero(valid))
+        # Convert to (time, x, y, z) rows
+        rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
+        ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
+        rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+              - ((yzhigh & 0x40) << 7))
+        raw_xyz = (rx[valid], ry[valid], rz[valid])
+        samples = numpy.empty((len(raw_xyz[0]), 4))
+        samples[:,0] = time_base + (msg_cdiff + msg_index)[valid] * inv_freq
+        samples[:,1] = raw_xyz[x_pos] * x_scale
+        samples[:,2] = raw_xyz[y_pos] * y_scale
+        samples[:,3] = raw_xyz[z_pos] * z_scale
+        numpy.round(samples, 6, out=samples)
+        self.clock_sync.set_last_chip_clock(
+            int(seqs[-1]) * SAMPLES_PER_BLOCK + max(int(counts[-1]) - 1, 0))
+        return samples
     def _update_clock(self, minclock=0):
         # Query current state
         for retry in range(5):
@@ -421,7 +500,7 @@ class ADXL345:
         if not raw_samples:
             return {}
         samples = self._extract_samples(raw_samples)
-        if not samples:
+        if not len(samples):
             return {}
         return {'data': samples, 'errors': self.last_error_count,
                 'overflows': self.last_limit_count}
@@ -438,8 +438,8 @@ class Angle:
             "query_spi_angle oid=%d clock=0 rest_ticks=0 time_shift=0"
             % (oid,), on_restart=True)
         mcu.register_config_callback(self._build_config)
-        mcu.register_response(self._handle_spi_angle_data,
-                              "spi_angle_data", oid)
+        mcu.register_batch_response(self._handle_spi_angle_data,
+                                    "spi_angle_data", oid)
         # API server endpoints
         self.api_dump = motion_report.APIDumpHelper(
             self.printer, self._api_update, self._api_startstop, 0.100)
@@ -463,9 +463,9 @@ class Angle:
     # Measurement collection
     def is_measuring(self):
         return self.start_clock != 0
-    def _handle_spi_angle_data(self, params):
+    def _handle_spi_angle_data(self, msgs):
         with self.lock:
-            self.raw_samples.append(params)
+            self.raw_samples.extend(msgs)
     def _extract_samples(self, raw_samples):
         # Load variables to optimize inner loop below
         sample_ticks = self.sample_ticks
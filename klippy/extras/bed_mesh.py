@@ -5,6 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, json, collections
+import chelper
 from . import probe
 
 PROFILE_VERSION = 1
@@ -31,10 +32,6 @@ def within(coord, min_c, max_c, tol=0.0):
 def constrain(val, min_val, max_val):
     return min(max_val, max(min_val, val))
 
-# Linear interpolation between two values
-def lerp(t, v0, v1):
-    return (1. - t) * v0 + t * v1
-
 # retreive commma separated pair from config
 def parse_config_pair(config, option, default, minval=None, maxval=None):
     pair = config.getintlist(option, (default, default))
@@ -209,14 +206,9 @@ class BedMesh:
                     % (z, self.fade_target))
             self.toolhead.move([x, y, z + self.fade_target, e], speed)
         else:
-            self.splitter.build_move(self.last_position, newpos, factor)
-            while not self.splitter.traverse_complete:
-                split_move = self.splitter.split()
-                if split_move:
-                    self.toolhead.move(split_move, speed)
-                else:
-                    raise self.gcode.error(
-                        "Mesh Leveling: Error splitting move ")
+            for split_move in self.splitter.split_move(self.last_position,
+                                                       newpos, factor):
+                self.toolhead.move(split_move, speed)
         self.last_position[:] = newpos
     def get_status(self, eventtime=None):
         return self.status
@@ -748,62 +740,41 @@ class MoveSplitter:
             'split_delta_z', .025, minval=0.01)
         self.move_check_distance = config.getfloat(
             'move_check_distance', 5., minval=3.)
+        split_modes = {'sample': 'sample', 'grid': 'grid'}
+        self.split_mode = config.getchoice('split_mode', split_modes,
+                                           'sample')
         self.z_mesh = None
         self.fade_offset = 0.
         self.gcode = gcode
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.bedmesh_split_move = ffi_lib.bedmesh_split_move
+        self.bedmesh_split_move_grid = ffi_lib.bedmesh_split_move_grid
+        self.ffi_main = ffi_main
+        self.out_size = 64
+        self.out = ffi_main.new("double[]", self.out_size * 4)
     def initialize(self, mesh, fade_offset):
         self.z_mesh = mesh
         self.fade_offset = fade_offset
-    def build_move(self, prev_pos, next_pos, factor):
-        self.prev_pos = tuple(prev_pos)
-        self.next_pos = tuple(next_pos)
-        self.current_pos = list(prev_pos)
-        self.z_factor = factor
-        self.z_offset = self._calc_z_offset(prev_pos)
-        self.traverse_complete = False
-        self.distance_checked = 0.
-        axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
-        self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
-        self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
-    def _calc_z_offset(self, pos):
-        z = self.z_mesh.calc_z(pos[0], pos[1])
-        offset = self.fade_offset
-        return self.z_factor * (z - offset) + offset
-    def _set_next_move(self, distance_from_prev):
-        t = distance_from_prev / self.total_move_length
-        if t > 1. or t < 0.:
-            raise self.gcode.error(
-                "bed_mesh: Slice distance is negative "
-                "or greater than entire move length")
-        for i in range(4):
-            if self.axis_move[i]:
-                self.current_pos[i] = lerp(
-                    t, self.prev_pos[i], self.next_pos[i])
-    def split(self):
-        if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
-                # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
-                    self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = self._calc_z_offset(self.current_pos)
-                    if abs(next_z - self.z_offset) >= self.split_delta_z:
-                        self.z_offset = next_z
-                        return self.current_pos[0], self.current_pos[1], \
-                            self.current_pos[2] + self.z_offset, \
-                            self.current_pos[3]
-            # end of move reached
-            self.current_pos[:] = self.next_pos
-            self.z_offset = self._calc_z_offset(self.current_pos)
-            # Its okay to add Z-Offset to the final move, since it will not be
-            # used again.
-            self.current_pos[2] += self.z_offset
-            self.traverse_complete = True
-            return self.current_pos
-        else:
-            # Traverse complete
-            return None
+    def _split(self, prev_pos, next_pos, factor):
+        if self.split_mode == 'grid':
+            return self.bedmesh_split_move_grid(
+                self.z_mesh.c_mesh, prev_pos, next_pos, factor,
+                self.fade_offset, self.split_delta_z,
+                self.out, self.out_size)
+        return self.bedmesh_split_move(
+            self.z_mesh.c_mesh, prev_pos, next_pos, factor, self.fade_offset,
+            self.move_check_distance, self.split_delta_z,
+            self.out, self.out_size)
+    def split_move(self, prev_pos, next_pos, factor):
+        # Split the move (in chelper/bedmesh.c) and return the
+        # adjusted end position of each segment
+        count = self._split(prev_pos, next_pos, factor)
+        if count > self.out_size:
+            self.out_size = count
+            self.out = self.ffi_main.new("double[]", count * 4)
+            count = self._split(prev_pos, next_pos, factor)
+        vals = self.ffi_main.unpack(self.out, count * 4)
+        return [vals[i:i+4] for i in range(0, count * 4, 4)]
 
 
 class ZMesh:
@@ -812,6 +783,10 @@ class ZMesh:
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offsets = [0., 0.]
+        # The interpolated mesh is evaluated in C (chelper/bedmesh.c)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.c_mesh = ffi_main.gc(ffi_lib.bedmesh_alloc(), ffi_lib.bedmesh_free)
+        self.bedmesh_calc_z = ffi_lib.bedmesh_calc_z
         logging.debug('bed_mesh: probe/mesh parameters:')
         for key, value in self.mesh_params.items():
             logging.debug("%s :  %s" % (key, value))
@@ -891,6 +866,11 @@ class ZMesh:
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        ffi_lib.bedmesh_set_mesh(
+            self.c_mesh, [z for line in self.mesh_matrix for z in line],
+            self.mesh_x_count, self.mesh_y_count, self.mesh_x_min,
+            self.mesh_y_min, self.mesh_x_dist, self.mesh_y_dist)
         self.avg_z = (sum([sum(x) for x in self.mesh_matrix]) /
                       sum([len(x) for x in self.mesh_matrix]))
         # Round average to the nearest 100th.  This
@@ -902,21 +882,14 @@ class ZMesh:
         for i, o in enumerate(offsets):
             if o is not None:
                 self.mesh_offsets[i] = o
+        ffi_main, ffi_lib = chelper.get_ffi()
+        ffi_lib.bedmesh_set_offsets(self.c_mesh, *self.mesh_offsets)
     def get_x_coordinate(self, index):
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
-            # No mesh table generated, no z-adjustment
-            return 0.
+        return self.bedmesh_calc_z(self.c_mesh, x, y)
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -924,24 +897,6 @@ class ZMesh:
             return mesh_min, mesh_max
         else:
             return 0., 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
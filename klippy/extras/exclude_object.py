@@ -5,14 +5,103 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
-import logging
+import logging, math, bisect
 import json
 
+# Distance (in mm) outside an object polygon that is still considered
+# to be part of the object during a position lookup
+LOOKUP_MARGIN = .5
+
+# Grid based index of object polygons, used to find the object at a
+# given XY position
+class ObjectIndex:
+    def __init__(self):
+        self.cell_size = 1.
+        self.cells = {}
+        self.last_hit = None
+    def _get_cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+    def update(self, objects):
+        self.cells = {}
+        self.last_hit = None
+        entries = []
+        for obj in objects:
+            polygon = obj.get('polygon')
+            if not polygon or len(polygon) < 3:
+                continue
+            try:
+                points = [(float(p[0]), float(p[1])) for p in polygon]
+            except (TypeError, ValueError, IndexError):
+                logging.info("Ignoring invalid polygon of object %s",
+                             obj['name'])
+                continue
+            xs = [p[0] for p in points]
+            ys = [p[1] for p in points]
+            bbox = (min(xs) - LOOKUP_MARGIN, min(ys) - LOOKUP_MARGIN,
+                    max(xs) + LOOKUP_MARGIN, max(ys) + LOOKUP_MARGIN)
+            entries.append((obj['name'], points, bbox))
+        if not entries:
+            return
+        # Size the cells to roughly match the size of the objects
+        sizes = [max(b[2] - b[0], b[3] - b[1]) for n, p, b in entries]
+        self.cell_size = max(1., sum(sizes) / len(sizes))
+        for entry in entries:
+            bbox = entry[2]
+            min_cx, min_cy = self._get_cell(bbox[0], bbox[1])
+            max_cx, max_cy = self._get_cell(bbox[2], bbox[3])
+            for cx in range(min_cx, max_cx + 1):
+                for cy in range(min_cy, max_cy + 1):
+                    self.cells.setdefault((cx, cy), []).append(entry)
+    def _check_entry(self, entry, x, y):
+        name, points, bbox = entry
+        if x < bbox[0] or x > bbox[2] or y < bbox[1] or y > bbox[3]:
+            return False
+        # Even-odd rule point in polygon test
+        inside = False
+        px, py = points[-1]
+        for cx, cy in points:
+            if (cy > y) != (py > y):
+                if x < px + (y - py) * (cx - px) / (cy - py):
+                    inside = not inside
+            px, py = cx, cy
+        if inside:
+            return True
+        # Accept positions on (or just outside) the outline
+        margin2 = LOOKUP_MARGIN**2
+        px, py = points[-1]
+        for cx, cy in points:
+            dx, dy = cx - px, cy - py
+            len2 = dx*dx + dy*dy
+            t = 0.
+            if len2:
+                t = max(0., min(1., ((x - px) * dx + (y - py) * dy) / len2))
+            ex, ey = px + t * dx - x, py + t * dy - y
+            if ex*ex + ey*ey <= margin2:
+                return True
+            px, py = cx, cy
+        return False
+    def lookup(self, x, y):
+        # Moves are usually local, so check the previous object first
+        last_hit = self.last_hit
+        if last_hit is not None and self._check_entry(last_hit, x, y):
+            return last_hit[0]
+        for entry in self.cells.get(self._get_cell(x, y), []):
+            if entry is not last_hit and self._check_entry(entry, x, y):
+                self.last_hit = entry
+                return entry[0]
+        return None
+
 class ExcludeObject:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode_move = self.printer.load_object(config, 'gcode_move')
+        self.object_index = None
+        self.index_pending = False
+        if config.getboolean('position_lookup', False):
+            self.object_index = ObjectIndex()
+        self.status_version = 0
         self.printer.register_event_handler('klippy:connect',
                                         self._handle_connect)
         self.printer.register_event_handler("virtual_sdcard:reset_file",
@@ -74,9 +163,15 @@ class ExcludeObject:
 
     def _reset_state(self):
         self.objects = []
+        self.object_table = {}
+        self.object_names = []
         self.excluded_objects = []
+        self.excluded_names = set()
         self.current_object = None
+        self.located_object = None
         self.in_excluded_region = False
+        self.index_pending = True
+        self.status_version += 1
 
     def _reset_file(self):
         self._reset_state()
@@ -164,20 +259,50 @@ class ExcludeObject:
             - (self.max_position_extruded - self.last_position_extruded[3])
         self._normal_move(newpos, speed)
 
+    def _get_active_object(self):
+        if self.current_object is not None:
+            return self.current_object
+        return self.located_object
+
     def _test_in_excluded_region(self):
         # Inside cancelled object
-        return self.current_object in self.excluded_objects \
+        return self._get_active_object() in self.excluded_names \
             and self.initial_extrusion_moves == 0
 
+    def _lookup_position(self, x, y):
+        if self.index_pending:
+            self.index_pending = False
+            self.object_index.update(self.objects)
+        return self.object_index.lookup(x, y)
+
+    def _locate_object(self, newpos):
+        # Find the object from the middle of the move, as the endpoints
+        # of extrusion moves are usually on the object outline
+        lastpos = self.last_position
+        if newpos[0] == lastpos[0] and newpos[1] == lastpos[1]:
+            return
+        # Object definitions are in gcode coordinates (without offsets)
+        base = self.gcode_move.base_position
+        name = self._lookup_position(.5 * (lastpos[0] + newpos[0]) - base[0],
+                                     .5 * (lastpos[1] + newpos[1]) - base[1])
+        if name != self.located_object:
+            self.located_object = name
+            self.status_version += 1
+
+    def get_status_version(self):
+        return self.status_version
+
     def get_status(self, eventtime=None):
         status = {
             "objects": self.objects,
             "excluded_objects": self.excluded_objects,
-            "current_object": self.current_object
+            "current_object": self._get_active_object()
         }
         return status
 
     def move(self, newpos, speed):
+        if self.object_index is not None and self.current_object is None:
+            self._locate_object(newpos)
         move_in_excluded_region = self._test_in_excluded_region()
         self.last_speed = speed
 
@@ -196,9 +321,11 @@ class ExcludeObject:
                                     " as labeled"
     def cmd_EXCLUDE_OBJECT_START(self, gcmd):
         name = gcmd.get('NAME').upper()
-        if not any(obj["name"] == name for obj in self.objects):
+        if name not in self.object_table:
             self._add_object_definition({"name": name})
         self.current_object = name
+        self.located_object = None
+        self.status_version += 1
         self.was_excluded_at_start = self._test_in_excluded_region()
 
     cmd_EXCLUDE_OBJECT_END_help = "Marks the end the current object"
@@ -214,6 +341,7 @@ class ExcludeObject:
                               (name.upper(), self.current_object))
 
         self.current_object = None
+        self.status_version += 1
 
     cmd_EXCLUDE_OBJECT_help = "Cancel moves inside a specified objects"
     def cmd_EXCLUDE_OBJECT(self, gcmd):
@@ -227,17 +355,26 @@ class ExcludeObject:
 
             else:
                 self.excluded_objects = []
+                self.excluded_names = set()
+                self.status_version += 1
 
         elif name:
-            if name.upper() not in self.excluded_objects:
+            if name.upper() not in self.excluded_names:
                 self._exclude_object(name.upper())
 
         elif current:
-            if not self.current_object:
+            current_object = self.current_object
+            if not current_object and self.object_index is not None:
+                current_object = self.located_object
+                if not current_object:
+                    # Object definitions are in gcode coordinates
+                    pos = self.gcode_move.get_status()['gcode_position']
+                    current_object = self._lookup_position(pos.x, pos.y)
+            if not current_object:
                 gcmd.respond_error('There is no current object to cancel')
 
             else:
-                self._exclude_object(self.current_object)
+                self._exclude_object(current_object)
 
         else:
             self._list_excluded_objects(gcmd)
@@ -271,21 +408,35 @@ class ExcludeObject:
             self._list_objects(gcmd)
 
     def _add_object_definition(self, definition):
-        self.objects = sorted(self.objects + [definition],
-                              key=lambda o: o["name"])
+        # The status lists are replaced (instead of modified) so that
+        # status subscribers can detect changes by identity
+        name = definition["name"]
+        objects = list(self.objects)
+        pos = bisect.bisect_left(self.object_names, name)
+        if name in self.object_table:
+            objects[pos] = definition
+        else:
+            self.object_names.insert(pos, name)
+            objects.insert(pos, definition)
+        self.object_table[name] = definition
+        self.objects = objects
+        self.index_pending = True
+        self.status_version += 1
 
     def _exclude_object(self, name):
         self._register_transform()
         self.gcode.respond_info('Excluding object {}'.format(name.upper()))
-        if name not in self.excluded_objects:
-            self.excluded_objects = sorted(self.excluded_objects + [name])
+        if name not in self.excluded_names:
+            self.excluded_names.add(name)
+            self.excluded_objects = sorted(self.excluded_names)
+            self.status_version += 1
 
     def _unexclude_object(self, name):
         self.gcode.respond_info('Unexcluding object {}'.format(name.upper()))
-        if name in self.excluded_objects:
-            excluded_objects = list(self.excluded_objects)
-            excluded_objects.remove(name)
-            self.excluded_objects = sorted(excluded_objects)
+        if name in self.excluded_names:
+            self.excluded_names.remove(name)
+            self.excluded_objects = sorted(self.excluded_names)
+            self.status_version += 1
 
     def _list_objects(self, gcmd):
         if gcmd.get('JSON', None) is not None:
@@ -3,19 +3,109 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import traceback, logging, ast, copy
+import traceback, logging, ast, os, hashlib
 import jinja2
 
+TEMPLATE_CACHE_DIR = "~/.cache/klipper/jinja2"
+
 
 ######################################################################
 # Template handling
 ######################################################################
 
+# Dictionaries and lists in the status information are copied (one
+# level at a time) only as a template accesses them.  This prevents a
+# template from altering the state of a printer object while avoiding
+# a full copy of each status.
+def wrap_status(val):
+    if isinstance(val, (StatusDict, StatusList)):
+        return val
+    if isinstance(val, dict):
+        return StatusDict(val)
+    if isinstance(val, list):
+        return StatusList(val)
+    if isinstance(val, tuple):
+        # Tuples can't be altered, but their contents may be
+        items = [wrap_status(v) for v in val]
+        if all([w is v for w, v in zip(items, val)]):
+            return val
+        if hasattr(val, '_fields'):
+            # namedtuple
+            return type(val)(*items)
+        return tuple(items)
+    return val
+
+class StatusDict(dict):
+    def __getitem__(self, key):
+        val = dict.__getitem__(self, key)
+        wval = wrap_status(val)
+        if wval is not val:
+            dict.__setitem__(self, key, wval)
+        return wval
+    def __iter__(self):
+        return iter(self.keys())
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+    def values(self):
+        return [self[key] for key in list(self.keys())]
+    def items(self):
+        return [(key, self[key]) for key in list(self.keys())]
+    def pop(self, key, *args):
+        if key in self:
+            self[key]
+        return dict.pop(self, key, *args)
+    def popitem(self):
+        key, val = dict.popitem(self)
+        return key, wrap_status(val)
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+    def copy(self):
+        return StatusDict(self.items())
+    def __or__(self, other):
+        res = dict(self)
+        res.update(other)
+        return res
+
+class StatusList(list):
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        val = list.__getitem__(self, index)
+        wval = wrap_status(val)
+        if wval is not val:
+            list.__setitem__(self, index, wval)
+        return wval
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+    def pop(self, index=-1):
+        self[index]
+        return list.pop(self, index)
+    def copy(self):
+        return StatusList(self)
+    def __add__(self, other):
+        return list(self) + other
+    def __radd__(self, other):
+        return other + list(self)
+    def __mul__(self, count):
+        return list(self) * count
+    __rmul__ = __mul__
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
-    def __init__(self, printer, eventtime=None):
+    def __init__(self, printer, eventtime=None, status_cache=None):
         self.printer = printer
         self.eventtime = eventtime
+        self.shared_eventtime = eventtime is not None
+        self.status_cache = status_cache
         self.cache = {}
     def __getitem__(self, val):
         sval = str(val).strip()
@@ -26,7 +116,12 @@ class GetStatusWrapper:
             raise KeyError(val)
         if self.eventtime is None:
             self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        if self.status_cache is None:
+            status = po.get_status(self.eventtime)
+        else:
+            status = self.status_cache.get_status(sval, po, self.eventtime,
+                                                  self.shared_eventtime)
+        self.cache[sval] = res = wrap_status(status)
         return res
     def __contains__(self, val):
         try:
@@ -39,6 +134,50 @@ class GetStatusWrapper:
             if self.__contains__(name):
                 yield name
 
+# Memoization of get_status() results shared by all templates.  A
+# result is reused for templates rendered with the same requested
+# eventtime (eg, display and led templates) and, for objects that
+# implement get_status_version(), until the object reports a new
+# version.
+class StatusCache:
+    def __init__(self):
+        self.results = {}
+    def get_status(self, name, po, eventtime, shared_eventtime):
+        version = None
+        if hasattr(po, 'get_status_version'):
+            version = po.get_status_version()
+        res = self.results.get(name)
+        if res is not None and res[0] is po and (
+                (shared_eventtime and res[1] == eventtime)
+                or (version is not None and res[2] == version)):
+            return res[3]
+        status = po.get_status(eventtime)
+        self.results[name] = (po, eventtime if shared_eventtime else None,
+                              version, status)
+        return status
+
+# Compile a template, using the environment's bytecode cache (if any)
+def compile_template(env, script):
+    bcc = env.bytecode_cache
+    if bcc is None:
+        return env.from_string(script)
+    # Templates are cached by a hash of their source (and delimiters)
+    key = "%s %s %s %s %s" % (
+        env.block_start_string, env.block_end_string,
+        env.variable_start_string, env.variable_end_string, script)
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    name = hashlib.sha1(key).hexdigest()
+    bucket = bcc.get_bucket(env, name, None, script)
+    if bucket.code is None:
+        bucket.code = env.compile(script)
+        try:
+            bcc.set_bucket(bucket)
+        except EnvironmentError:
+            logging.exception("Unable to store template in bytecode cache")
+    return env.template_class.from_code(env, bucket.code,
+                                        env.make_globals(None), None)
+
 # Wrapper around a Jinja2 template
 class TemplateWrapper:
     def __init__(self, printer, env, name, script):
@@ -47,14 +186,25 @@ class TemplateWrapper:
         self.gcode = self.printer.lookup_object('gcode')
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
+        self.template = self.constant_script = self.constant_lines = None
+        if '{' not in script and '\r' not in script:
+            # Template without any expressions - the output is the
+            # script itself (less the final newline, as with Jinja2)
+            if script.endswith('\n'):
+                script = script[:-1]
+            self.constant_script = script
+            self.constant_lines = script.split('\n')
+            return
         try:
-            self.template = env.from_string(script)
+            self.template = compile_template(env, script)
         except Exception as e:
             msg = "Error loading template '%s': %s" % (
                  name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise printer.config_error(msg)
     def render(self, context=None):
+        if self.constant_script is not None:
+            return self.constant_script
         if context is None:
             context = self.create_template_context()
         try:
@@ -65,13 +215,36 @@ class TemplateWrapper:
             logging.exception(msg)
             raise self.gcode.error(msg)
     def run_gcode_from_command(self, context=None):
-        self.gcode.run_script_from_command(self.render(context))
+        if self.constant_lines is not None:
+            self.gcode.run_commands_from_command(self.constant_lines)
+            return
+        self.gcode.run_commands_from_command(self.render(context).split('\n'))
 
 # Main gcode macro template tracking
 class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
-        self.env = jinja2.Environment('{%', '%}', '{', '}')
+        self.env = jinja2.Environment('{%', '%}', '{', '}',
+                                      bytecode_cache=self._create_cache())
+        self.status_cache = StatusCache()
+    def _create_cache(self):
+        # Persistent cache of compiled templates (speeds up restarts)
+        start_args = self.printer.get_start_args()
+        if (not start_args.get('template_cache', True)
+            or start_args.get('debugoutput') is not None):
+            return None
+        cache_dir = os.path.expanduser(TEMPLATE_CACHE_DIR)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+        except EnvironmentError as e:
+            logging.info("Template cache disabled: %s", str(e))
+            return None
+        if not os.access(cache_dir, os.W_OK):
+            logging.info("Template cache disabled: %s is not writable",
+                         cache_dir)
+            return None
+        return jinja2.FileSystemBytecodeCache(cache_dir)
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
@@ -96,7 +269,8 @@ class PrinterGCodeMacro:
         return ""
     def create_template_context(self, eventtime=None):
         return {
-            'printer': GetStatusWrapper(self.printer, eventtime),
+            'printer': GetStatusWrapper(self.printer, eventtime,
+                                        self.status_cache),
             'action_emergency_stop': self._action_emergency_stop,
             'action_respond_info': self._action_respond_info,
             'action_raise_error': self._action_raise_error,
@@ -141,6 +315,7 @@ class GCodeMacro:
                                         desc=self.cmd_SET_GCODE_VARIABLE_help)
         self.in_script = False
         self.variables = {}
+        self.status_version = 0
         prefix = 'variable_'
         for option in config.get_prefix_options(prefix):
             try:
@@ -161,6 +336,8 @@ class GCodeMacro:
         self.gcode.register_command(self.alias, self.cmd, desc=self.cmd_desc)
     def get_status(self, eventtime):
         return self.variables
+    def get_status_version(self):
+        return self.status_version
     cmd_SET_GCODE_VARIABLE_help = "Set the value of a G-Code macro variable"
     def cmd_SET_GCODE_VARIABLE(self, gcmd):
         variable = gcmd.get('VARIABLE')
@@ -174,6 +351,7 @@ class GCodeMacro:
         v = dict(self.variables)
         v[variable] = literal
         self.variables = v
+        self.status_version += 1
     def cmd(self, gcmd):
         if self.in_script:
             raise gcmd.error("Macro %s called recursively" % (self.alias,))
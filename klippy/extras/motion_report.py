@@ -86,14 +86,21 @@ class APIDumpHelper:
 class InternalDumpClient:
     def __init__(self):
         self.msgs = []
+        self.msg_callback = None
         self.is_done = False
     def get_messages(self):
         return self.msgs
+    def set_msg_callback(self, callback):
+        # Pass messages to the callback instead of storing them
+        self.msg_callback = callback
     def finalize(self):
         self.is_done = True
     def is_closed(self):
         return self.is_done
     def send(self, msg):
+        if self.msg_callback is not None:
+            self.msg_callback(msg)
+            return
         self.msgs.append(msg)
         if len(self.msgs) >= 10000:
             # Avoid filling up memory with too many samples
@@ -74,7 +74,8 @@ class MPU9250:
         self.query_mpu9250_cmd = self.query_mpu9250_end_cmd = None
         self.query_mpu9250_status_cmd = None
         mcu.register_config_callback(self._build_config)
-        mcu.register_response(self._handle_mpu9250_data, "mpu9250_data", oid)
+        mcu.register_batch_response(self._handle_mpu9250_data, "mpu9250_data",
+                                    oid)
         # Clock tracking
         self.last_sequence = self.max_query_duration = 0
         self.last_limit_count = self.last_error_count = 0
@@ -112,9 +113,9 @@ class MPU9250:
     # Measurement collection
     def is_measuring(self):
         return self.query_rate > 0
-    def _handle_mpu9250_data(self, params):
+    def _handle_mpu9250_data(self, msgs):
         with self.lock:
-            self.raw_samples.append(params)
+            self.raw_samples.extend(msgs)
     def _extract_samples(self, raw_samples):
         # Load variables to optimize inner loop below
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
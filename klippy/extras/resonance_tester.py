@@ -180,6 +180,12 @@ class ResonanceTester:
                     for chip in accel_chips:
                         aclient = chip.start_internal_client()
                         raw_values.append((axis, aclient, chip.name))
+                accumulators = {}
+                if helper is not None and raw_name_suffix is None:
+                    # Raw data is not needed - process it as it arrives
+                    for chip_axis, aclient, chip_name in raw_values:
+                        accumulators[aclient] = (
+                            helper.start_accelerometer_processing(aclient))
 
                 # Generate moves
                 self.test.run_test(axis, gcmd)
@@ -201,7 +207,8 @@ class ResonanceTester:
                         raise gcmd.error(
                             "accelerometer '%s' measured no data" % (
                                 chip_name,))
-                    new_data = helper.process_accelerometer_data(aclient)
+                    new_data = helper.process_accelerometer_data(
+                            accumulators.get(aclient, aclient))
                     if calibration_data[axis] is None:
                         calibration_data[axis] = new_data
                     else:
@@ -4,11 +4,13 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import collections, importlib, logging, math, multiprocessing, traceback
+import multiprocessing.connection
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
 WINDOW_T_SEC = 0.5
+STREAM_SETUP_T_SEC = 1.
 MAX_SHAPER_FREQ = 150.
 
 TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
@@ -53,6 +55,77 @@ class CalibrationData:
         return self._psd_map[axis]
 
 
+# Welch's algorithm PSD calculation performed on samples as they arrive
+# (only the running sums of the window responses are retained)
+class FreqResponseAccumulator:
+    def __init__(self, helper):
+        self.helper = helper
+        self.numpy = helper.numpy
+        self.pending = []
+        self.pending_count = self.sample_count = 0
+        self.first_time = self.last_time = None
+        self.nfft = self.window = self.psd_sums = None
+        self.window_count = 0
+    def add_samples(self, samples):
+        if not len(samples):
+            return
+        if self.first_time is None:
+            self.first_time = samples[0,0]
+        self.last_time = samples[-1,0]
+        self.sample_count += len(samples)
+        self.pending.append(samples)
+        self.pending_count += len(samples)
+        if self.nfft is None:
+            # Estimate the sampling frequency before choosing a window size
+            T = self.last_time - self.first_time
+            if T < STREAM_SETUP_T_SEC:
+                return
+            sampling_freq = self.sample_count / T
+            np = self.numpy
+            self.nfft = 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+            self.window = np.kaiser(self.nfft, 6.)
+            self.psd_sums = np.zeros((self.nfft // 2 + 1, 3))
+        if self.pending_count >= self.nfft:
+            self._process_windows()
+    def _process_windows(self):
+        np = self.numpy
+        nfft = self.nfft
+        overlap = nfft // 2
+        step = nfft - overlap
+        data = np.concatenate(self.pending)
+        n_windows = (len(data) - overlap) // step
+        if n_windows > 0:
+            for axis in range(3):
+                x = np.ascontiguousarray(data[:n_windows * step + overlap,
+                                              axis + 1])
+                x = self.helper._split_into_windows(x, nfft, overlap)
+                # Detrend, apply windowing function, and calculate FFT
+                x = self.window[:, None] * (x - np.mean(x, axis=0))
+                result = np.fft.rfft(x, n=nfft, axis=0)
+                result = np.conjugate(result) * result
+                self.psd_sums[:,axis] += result.real.sum(axis=-1)
+            self.window_count += n_windows
+            data = data[n_windows * step:]
+        self.pending = [data]
+        self.pending_count = len(data)
+    def get_calibration_data(self):
+        np = self.numpy
+        if self.nfft is None:
+            # Too few samples were received to stream - process them now
+            if not self.pending:
+                return None
+            return self.helper.calc_freq_response(np.concatenate(self.pending))
+        if not self.window_count:
+            return None
+        sampling_freq = self.sample_count / (self.last_time - self.first_time)
+        scale = 1.0 / (self.window**2).sum()
+        psd = self.psd_sums * (scale / sampling_freq / self.window_count)
+        # Double the one-sided response (except 'DC' and Nyquist terms)
+        psd[1:-1,:] *= 2.
+        px, py, pz = [np.array(psd[:,axis]) for axis in range(3)]
+        freqs = np.fft.rfftfreq(self.nfft, 1. / sampling_freq)
+        return CalibrationData(freqs, px+py+pz, px, py, pz)
+
 CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score', 'max_accel'))
@@ -69,13 +142,12 @@ class ShaperCalibrate:
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
 
-    def background_process_exec(self, method, args):
-        if self.printer is None:
-            return method(*args)
-        import queuelogger
+    def _start_background_process(self, method, args):
         parent_conn, child_conn = multiprocessing.Pipe()
         def wrapper():
-            queuelogger.clear_bg_logging()
+            if self.printer is not None:
+                import queuelogger
+                queuelogger.clear_bg_logging()
             try:
                 res = method(*args)
             except:
@@ -88,22 +160,62 @@ class ShaperCalibrate:
         calc_proc = multiprocessing.Process(target=wrapper)
         calc_proc.daemon = True
         calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
-            if eventtime > last_report_time + 5.:
-                last_report_time = eventtime
-                gcode.respond_info("Wait for calculations..", log=False)
-            eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+        return calc_proc, parent_conn
+
+    def background_process_map(self, method, args_list):
+        # Run each calculation in its own process, with up to one running
+        # process per cpu core, and return the results in order
+        if self.printer is None and len(args_list) <= 1:
+            return [method(*args) for args in args_list]
+        max_procs = multiprocessing.cpu_count()
+        pending = list(enumerate(args_list))
+        pending.reverse()
+        running = {}
+        results = [None] * len(args_list)
+        if self.printer is not None:
+            reactor = self.printer.get_reactor()
+            gcode = self.printer.lookup_object("gcode")
+            eventtime = last_report_time = reactor.monotonic()
+        try:
+            while pending or running:
+                while pending and len(running) < max_procs:
+                    idx, args = pending.pop()
+                    running[idx] = self._start_background_process(method,
+                                                                  args)
+                # Wait for a process to finish
+                if self.printer is None:
+                    multiprocessing.connection.wait(
+                            [conn for proc, conn in running.values()], .1)
+                else:
+                    if eventtime > last_report_time + 5.:
+                        last_report_time = eventtime
+                        gcode.respond_info("Wait for calculations..",
+                                           log=False)
+                    eventtime = reactor.pause(eventtime + .1)
+                # Collect results
+                for idx, (calc_proc, conn) in list(running.items()):
+                    is_alive = calc_proc.is_alive()
+                    if not conn.poll():
+                        if is_alive:
+                            continue
+                        raise self.error("Remote calculation process exited"
+                                         " unexpectedly")
+                    is_err, res = conn.recv()
+                    calc_proc.join()
+                    conn.close()
+                    del running[idx]
+                    if is_err:
+                        raise self.error("Error in remote calculation: %s"
+                                         % (res,))
+                    results[idx] = res
+        finally:
+            for calc_proc, conn in running.values():
+                calc_proc.terminate()
+                conn.close()
+        return results
+
+    def background_process_exec(self, method, args):
+        return self.background_process_map(method, [args])[0]
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -153,9 +265,9 @@ class ShaperCalibrate:
             data = raw_values
         else:
             samples = raw_values.get_samples()
-            if not samples:
+            if not len(samples):
                 return None
-            data = np.array(samples)
+            data = np.asarray(samples)
 
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
@@ -172,9 +284,18 @@ class ShaperCalibrate:
         fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
         return CalibrationData(fx, px+py+pz, px, py, pz)
 
+    def start_accelerometer_processing(self, aclient):
+        # Calculate the frequency response while the measurements arrive
+        accumulator = FreqResponseAccumulator(self)
+        aclient.set_samples_callback(accumulator.add_samples)
+        return accumulator
+
     def process_accelerometer_data(self, data):
-        calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
+        if isinstance(data, FreqResponseAccumulator):
+            calibration_data = data.get_calibration_data()
+        else:
+            calibration_data = self.background_process_exec(
+                    self.calc_freq_response, (data,))
         if calibration_data is None:
             raise self.error(
                     "Internal error processing accelerometer data %s" % (data,))
@@ -182,18 +303,22 @@ class ShaperCalibrate:
         return calibration_data
 
     def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+        # The shaper may also be a set of shapers (2-D arrays of amplitudes
+        # and times), in which case a row of responses is returned for each
         np = self.numpy
 
-        A, T = np.array(shaper[0]), np.array(shaper[1])
-        inv_D = 1. / A.sum()
+        A, T = np.asarray(shaper[0]), np.asarray(shaper[1])
+        inv_D = 1. / A.sum(axis=-1)
 
         omega = 2. * math.pi * test_freqs
         damping = test_damping_ratio * omega
         omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
-        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
-        S = W * np.sin(np.outer(omega_d, T))
-        C = W * np.cos(np.outer(omega_d, T))
-        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
+        A = A[..., None, :]
+        W = A * np.exp((-damping)[:, None] * (T[..., -1:] - T)[..., None, :])
+        S = W * np.sin(omega_d[:, None] * T[..., None, :])
+        C = W * np.cos(omega_d[:, None] * T[..., None, :])
+        return (np.sqrt(S.sum(axis=-1)**2 + C.sum(axis=-1)**2)
+                * inv_D[..., None])
 
     def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
                                        freq_bins, psd):
@@ -203,7 +328,7 @@ class ShaperCalibrate:
         # threshold can be igonred
         vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
         remaining_vibrations = self.numpy.maximum(
-                vals * psd - vibr_threshold, 0).sum()
+                vals * psd - vibr_threshold, 0).sum(axis=-1)
         all_vibrations = self.numpy.maximum(psd - vibr_threshold, 0).sum()
         return (remaining_vibrations / all_vibrations, vals)
 
@@ -236,25 +361,39 @@ class ShaperCalibrate:
         psd = calibration_data.psd_sum[freq_bins <= MAX_FREQ]
         freq_bins = freq_bins[freq_bins <= MAX_FREQ]
 
-        best_res = None
-        results = []
+        # Test frequencies from the highest, stopping once the smoothing
+        # exceeds max_smoothing
+        shapers = []
+        smoothings = []
+        stopped_early = False
         for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
             shaper = shaper_cfg.init_func(
                     test_freq, shaper_defs.DEFAULT_DAMPING_RATIO)
             shaper_smoothing = self._get_shaper_smoothing(shaper)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
-            for dr in TEST_DAMPING_RATIOS:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper)
+            if max_smoothing and shaper_smoothing > max_smoothing and shapers:
+                stopped_early = True
+                break
+            shapers.append(shaper)
+            smoothings.append(shaper_smoothing)
+        test_freqs = test_freqs[::-1][:len(shapers)]
+        # Estimate the response of all the test shapers at once. Exact
+        # damping ratio of the printer is unknown, pessimizing remaining
+        # vibrations over possible damping values
+        all_shapers = (np.array([A for A, T in shapers]),
+                       np.array([T for A, T in shapers]))
+        all_vibrations = np.zeros(shape=test_freqs.shape)
+        all_vals = np.zeros(shape=test_freqs.shape + freq_bins.shape)
+        for dr in TEST_DAMPING_RATIOS:
+            vibrations, vals = self._estimate_remaining_vibrations(
+                    all_shapers, dr, freq_bins, psd)
+            all_vals = np.maximum(all_vals, vals)
+            all_vibrations = np.maximum(all_vibrations, vibrations)
+
+        best_idx = None
+        results = []
+        for i, test_freq in enumerate(test_freqs):
+            shaper_vibrations = all_vibrations[i]
+            shaper_smoothing = smoothings[i]
             # The score trying to minimize vibrations, but also accounting
             # the growth of smoothing. The formula itself does not have any
             # special meaning, it simply shows good results on real user data
@@ -262,19 +401,25 @@ class ShaperCalibrate:
                                                shaper_vibrations * .2 + .01)
             results.append(
                     CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
+                        name=shaper_cfg.name, freq=test_freq, vals=all_vals[i],
                         vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
-            if best_res is None or best_res.vibrs > results[-1].vibrs:
+                        score=shaper_score, max_accel=None))
+            if best_idx is None or results[best_idx].vibrs > shaper_vibrations:
                 # The current frequency is better for the shaper.
-                best_res = results[-1]
-        # Try to find an 'optimal' shapper configuration: the one that is not
-        # much worse than the 'best' one, but gives much less smoothing
-        selected = best_res
-        for res in results[::-1]:
-            if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
-                selected = res
-        return selected
+                best_idx = i
+        selected_idx = best_idx
+        if not stopped_early:
+            # Try to find an 'optimal' shapper configuration: the one that is
+            # not much worse than the 'best' one, but gives much less smoothing
+            best_res = results[best_idx]
+            for i in range(len(results) - 1, -1, -1):
+                res = results[i]
+                if (res.vibrs < best_res.vibrs * 1.1
+                        and res.score < results[selected_idx].score):
+                    selected_idx = i
+        # Only the selected shaper needs its (slow to find) max_accel
+        max_accel = self.find_shaper_max_accel(shapers[selected_idx])
+        return results[selected_idx]._replace(max_accel=max_accel)
 
     def _bisect(self, func):
         left = right = 1.
@@ -303,11 +448,13 @@ class ShaperCalibrate:
     def find_best_shaper(self, calibration_data, max_smoothing, logger=None):
         best_shaper = None
         all_shapers = []
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in AUTOTUNE_SHAPERS:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, max_smoothing))
+        # Fit all the shapers concurrently
+        shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                       if shaper_cfg.name in AUTOTUNE_SHAPERS]
+        fitted_shapers = self.background_process_map(self.fit_shaper, [
+            (shaper_cfg, calibration_data, max_smoothing)
+            for shaper_cfg in shaper_cfgs])
+        for shaper in fitted_shapers:
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
@@ -3,10 +3,87 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, io
+import os, logging, io, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
+READ_SIZE = 64 * 1024
+READ_AHEAD_CHUNKS = 16
+READ_WAIT_TIME = .010
+
+# Returned by FileReadAhead.get_lines() on a read error
+READ_ERROR = object()
+
+# Background thread that reads ahead in the file being printed and
+# splits the upcoming data into lines.  The thread seeks to its own
+# position before each read (while holding file_lock) so that a
+# stopped thread can't disturb the reads of its replacement.
+class FileReadAhead:
+    def __init__(self, reactor, current_file, file_lock, position):
+        self.reactor = reactor
+        self.current_file = current_file
+        self.file_lock = file_lock
+        self.position = position
+        self.chunks = queue.Queue(READ_AHEAD_CHUNKS)
+        self.must_stop = False
+        self.thread = threading.Thread(target=self._read_thread)
+        self.thread.daemon = True
+        self.thread.start()
+    def _put(self, item):
+        while not self.must_stop:
+            try:
+                self.chunks.put(item, timeout=0.100)
+                return
+            except queue.Full:
+                pass
+    def _read_thread(self):
+        partial_input = ""
+        position = self.position
+        while not self.must_stop:
+            try:
+                with self.file_lock:
+                    self.current_file.seek(position)
+                    data = self.current_file.read(READ_SIZE)
+                    position = self.current_file.tell()
+            except:
+                if not self.must_stop:
+                    logging.exception("virtual_sdcard read")
+                    self._put(READ_ERROR)
+                return
+            if not data:
+                # End of file
+                self._put(None)
+                return
+            lines = data.split('\n')
+            lines[0] = partial_input + lines[0]
+            partial_input = lines.pop()
+            if lines:
+                lines.reverse()
+                self._put(lines)
+    def get_lines(self):
+        # Returns a reversed list of lines, None on end of file, or
+        # READ_ERROR on a read error.  If the reader thread has not yet
+        # caught up, this waits for it without blocking the reactor.
+        while not self.must_stop:
+            try:
+                return self.chunks.get_nowait()
+            except queue.Empty:
+                self.reactor.pause(self.reactor.monotonic() + READ_WAIT_TIME)
+        return []
+    def stop(self):
+        # Signal the thread to exit; discarding the queued lines lets a
+        # pending put() return immediately, so this doesn't wait for it
+        self.must_stop = True
+        try:
+            while 1:
+                self.chunks.get_nowait()
+        except queue.Empty:
+            pass
+
 class VirtualSD:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -24,6 +101,8 @@ class VirtualSD:
         self.must_pause_work = self.cmd_from_sd = False
         self.next_file_position = 0
         self.work_timer = None
+        self.read_ahead = None
+        self.file_lock = threading.Lock()
         # Error handling
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.on_error_gcode = gcode_macro.load_template(
@@ -43,11 +122,13 @@ class VirtualSD:
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
+            self._stop_read_ahead()
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
-                self.current_file.seek(readpos)
-                data = self.current_file.read(readcount + 128)
+                with self.file_lock:
+                    self.current_file.seek(readpos)
+                    data = self.current_file.read(readcount + 128)
             except:
                 logging.exception("virtual_sdcard shutdown read")
                 return
@@ -116,8 +197,7 @@ class VirtualSD:
     def do_cancel(self):
         if self.current_file is not None:
             self.do_pause()
-            self.current_file.close()
-            self.current_file = None
+            self._close_file()
             self.print_stats.note_cancel()
         self.file_position = self.file_size = 0.
     # G-Code commands
@@ -126,8 +206,7 @@ class VirtualSD:
     def _reset_file(self):
         if self.current_file is not None:
             self.do_pause()
-            self.current_file.close()
-            self.current_file = None
+            self._close_file()
         self.file_position = self.file_size = 0.
         self.print_stats.reset()
         self.printer.send_event("virtual_sdcard:reset_file")
@@ -216,74 +295,84 @@ class VirtualSD:
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
     # Background work timer
+    def _stop_read_ahead(self):
+        if self.read_ahead is not None:
+            self.read_ahead.stop()
+            self.read_ahead = None
+    def _start_read_ahead(self):
+        self.read_ahead = FileReadAhead(self.reactor, self.current_file,
+                                        self.file_lock, self.file_position)
+    def _close_file(self):
+        self._stop_read_ahead()
+        with self.file_lock:
+            self.current_file.close()
+        self.current_file = None
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
-        try:
-            self.current_file.seek(self.file_position)
-        except:
-            logging.exception("virtual_sdcard seek")
-            self.work_timer = None
-            return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
+        self._start_read_ahead()
         lines = []
         error_message = None
         while not self.must_pause_work:
             if not lines:
-                # Read more data
-                try:
-                    data = self.current_file.read(8192)
-                except:
-                    logging.exception("virtual_sdcard read")
-                    break
-                if not data:
+                # Obtain more lines from the read ahead thread
+                lines = self.read_ahead.get_lines()
+                if lines is None:
                     # End of file
-                    self.current_file.close()
-                    self.current_file = None
+                    self._close_file()
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
+                if lines is READ_ERROR:
+                    lines = []
+                    break
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch a batch of commands
             self.cmd_from_sd = True
-            line = lines.pop()
-            next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
-            try:
-                self.gcode.run_script(line)
-            except self.gcode.error as e:
-                error_message = str(e)
+            need_seek = dispatch_failed = False
+            with gcode_mutex:
+                while lines and not self.must_pause_work:
+                    line = lines.pop()
+                    next_file_position = self.file_position + len(line) + 1
+                    self.next_file_position = next_file_position
+                    try:
+                        self.gcode.run_script_from_command(line)
+                    except self.gcode.error as e:
+                        error_message = str(e)
+                        break
+                    except:
+                        logging.exception("virtual_sdcard dispatch")
+                        dispatch_failed = True
+                        break
+                    self.file_position = self.next_file_position
+                    # Do we need to skip around?
+                    if self.next_file_position != next_file_position:
+                        need_seek = True
+                        break
+                    # Let any other pending request run
+                    if gcode_mutex.has_waiters():
+                        break
+            if error_message is not None:
                 try:
                     self.gcode.run_script(self.on_error_gcode.render())
                 except:
                     logging.exception("virtual_sdcard on_error")
                 break
-            except:
-                logging.exception("virtual_sdcard dispatch")
+            if dispatch_failed:
                 break
             self.cmd_from_sd = False
-            self.file_position = self.next_file_position
-            # Do we need to skip around?
-            if self.next_file_position != next_file_position:
-                try:
-                    self.current_file.seek(self.file_position)
-                except:
-                    logging.exception("virtual_sdcard seek")
-                    self.work_timer = None
-                    return self.reactor.NEVER
+            if need_seek:
+                self._stop_read_ahead()
+                self._start_read_ahead()
                 lines = []
-                partial_input = ""
+        self._stop_read_ahead()
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
@@ -10,6 +10,34 @@ class CommandError(Exception):
 
 Coord = collections.namedtuple('Coord', ('x', 'y', 'z', 'e'))
 
+PARSE_CACHE_SIZE = 256
+
+# Least recently used cache of parsing results
+class ParseCache:
+    def __init__(self, size=PARSE_CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+    def get(self, key):
+        res = self.entries.pop(key, None)
+        if res is None:
+            self.misses += 1
+            return None
+        self.entries[key] = res
+        self.hits += 1
+        return res
+    def set(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+    def get_status(self):
+        total = self.hits + self.misses
+        hit_rate = 0.
+        if total:
+            hit_rate = round(float(self.hits) / total, 3)
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': hit_rate}
+
 class GCodeCommand:
     error = CommandError
     def __init__(self, gcode, command, commandline, params, need_ack):
@@ -104,6 +132,9 @@ class GCodeDispatch:
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
         self.gcode_help = {}
+        # Parsing caches for commands run from macros
+        self.command_cache = ParseCache()
+        self.params_cache = ParseCache()
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115',
                     'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
@@ -172,25 +203,59 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
-    def _process_commands(self, commands, need_ack=True):
-        for line in commands:
-            # Ignore comments and leading/trailing spaces
-            line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            numparts = len(parts)
-            cmd = ""
-            if numparts >= 3 and parts[1] != 'N':
-                cmd = parts[1] + parts[2].strip()
-            elif numparts >= 5 and parts[1] == 'N':
-                # Skip line number at start of command
-                cmd = parts[3] + parts[4].strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, numparts, 2) }
+    move_cmds = {'G0': 'G0', 'G1': 'G1', 'G2': 'G2', 'G3': 'G3',
+                 'g0': 'G0', 'g1': 'G1', 'g2': 'G2', 'g3': 'G3'}
+    param_letters = {c: c.upper() for c in
+                     'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'}
+    def _parse_move_command(self, line):
+        # Fast parsing of plain "G1 X10 Y20.5 E.1" style move commands.
+        # Returns (None, None) if the line needs the generic parser.
+        parts = line.split()
+        if not parts:
+            return None, None
+        cmd = self.move_cmds.get(parts[0])
+        if cmd is None:
+            return None, None
+        params = {'G': cmd[1:]}
+        param_letters = self.param_letters
+        for part in parts[1:]:
+            letter = param_letters.get(part[0])
+            value = part[1:]
+            if letter is None or not value or value.strip('0123456789.-+'):
+                return None, None
+            params[letter] = value
+        return cmd, params
+    def _process_commands(self, commands, need_ack=True, parse_cache=None):
+        parse_move_command = self._parse_move_command
+        for rawline in commands:
+            entry = None
+            if parse_cache is not None:
+                entry = parse_cache.get(rawline)
+            if entry is not None:
+                origline, cmd, params = entry
+                params = dict(params)
+            else:
+                # Ignore comments and leading/trailing spaces
+                line = origline = rawline.strip()
+                cpos = line.find(';')
+                if cpos >= 0:
+                    line = line[:cpos]
+                cmd, params = parse_move_command(line)
+                if cmd is None:
+                    # Break line into parts and determine command
+                    parts = self.args_r.split(line.upper())
+                    numparts = len(parts)
+                    cmd = ""
+                    if numparts >= 3 and parts[1] != 'N':
+                        cmd = parts[1] + parts[2].strip()
+                    elif numparts >= 5 and parts[1] == 'N':
+                        # Skip line number at start of command
+                        cmd = parts[3] + parts[4].strip()
+                    # Build gcode "params" dictionary
+                    params = { parts[i]: parts[i+1].strip()
+                               for i in range(1, numparts, 2) }
+                if parse_cache is not None:
+                    parse_cache.set(rawline, (origline, cmd, dict(params)))
             gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
@@ -211,6 +276,11 @@ class GCodeDispatch:
             gcmd.ack()
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
+    def run_commands_from_command(self, commands):
+        # Run a list of (frequently repeated) commands, such as the
+        # output of a macro, caching the parsing of each line
+        self._process_commands(commands, need_ack=False,
+                               parse_cache=self.command_cache)
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
@@ -244,20 +314,25 @@ class GCodeDispatch:
         r'(?P<args>[^#*;]*?)'
         r'\s*(?:[#*;].*)?$')
     def _get_extended_params(self, gcmd):
-        m = self.extended_r.match(gcmd.get_commandline())
-        if m is None:
-            raise self.error("Malformed command '%s'"
-                             % (gcmd.get_commandline(),))
-        eargs = m.group('args')
-        try:
-            eparams = [earg.split('=', 1) for earg in shlex.split(eargs)]
-            eparams = { k.upper(): v for k, v in eparams }
-            gcmd._params.clear()
-            gcmd._params.update(eparams)
-            return gcmd
-        except ValueError as e:
-            raise self.error("Malformed command '%s'"
-                             % (gcmd.get_commandline(),))
+        commandline = gcmd.get_commandline()
+        eparams = self.params_cache.get(commandline)
+        if eparams is None:
+            m = self.extended_r.match(commandline)
+            if m is None:
+                raise self.error("Malformed command '%s'" % (commandline,))
+            eargs = m.group('args')
+            try:
+                eparams = [earg.split('=', 1) for earg in shlex.split(eargs)]
+                eparams = { k.upper(): v for k, v in eparams }
+            except ValueError as e:
+                raise self.error("Malformed command '%s'" % (commandline,))
+            self.params_cache.set(commandline, eparams)
+        gcmd._params.clear()
+        gcmd._params.update(eparams)
+        return gcmd
+    def get_status(self, eventtime):
+        return {'command_cache': self.command_cache.get_status(),
+                'params_cache': self.params_cache.get_status()}
     # G-Code special command handlers
     def cmd_default(self, gcmd):
         cmd = gcmd.get_command()
@@ -54,7 +54,7 @@ class DeltaKinematics:
             r.setup_itersolve('delta_stepper_alloc', a, t[0], t[1])
         for s in self.get_steppers():
             s.set_trapq(toolhead.get_trapq())
-            toolhead.register_step_generator(s.generate_steps)
+            toolhead.register_stepper(s)
         # Setup boundary checks
         self.need_home = True
         self.limit_xy2 = -1.
@@ -40,7 +40,7 @@ class DeltesianKinematics:
         self.rails[2].setup_itersolve('cartesian_stepper_alloc', b'y')
         for s in self.get_steppers():
             s.set_trapq(toolhead.get_trapq())
-            toolhead.register_step_generator(s.generate_steps)
+            toolhead.register_stepper(s)
         config.get_printer().register_event_handler(
             "stepper_enable:motor_off", self._motor_off)
         self.limits = [(1.0, -1.0)] * 3
@@ -45,7 +45,7 @@ class ExtruderStepper:
                                    desc=self.cmd_SYNC_STEPPER_TO_EXTRUDER_help)
     def _handle_connect(self):
         toolhead = self.printer.lookup_object('toolhead')
-        toolhead.register_step_generator(self.stepper.generate_steps)
+        toolhead.register_stepper(self.stepper)
         self._set_pressure_advance(self.config_pa, self.config_smooth_time)
     def get_status(self, eventtime):
         return {'pressure_advance': self.pressure_advance,
@@ -187,7 +187,7 @@ class PrinterExtruder:
         # Setup extruder trapq (trapezoidal motion queue)
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
-        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
         self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
         # Setup extruder stepper
         self.extruder_stepper = None
@@ -254,20 +254,23 @@ class PrinterExtruder:
             return (self.instant_corner_v / abs(diff_r))**2
         return move.max_cruise_v2
     def move(self, print_time, move):
-        axis_r = move.axes_r[3]
-        accel = move.accel * axis_r
-        start_v = move.start_v * axis_r
-        cruise_v = move.cruise_v * axis_r
-        can_pressure_advance = False
-        if axis_r > 0. and (move.axes_d[0] or move.axes_d[1]):
-            can_pressure_advance = True
+        self.process_moves([(print_time, move)])
+    def process_moves(self, moves):
         # Queue movement (x is extruder movement, y is pressure advance flag)
-        self.trapq_append(self.trapq, print_time,
-                          move.accel_t, move.cruise_t, move.decel_t,
-                          move.start_pos[3], 0., 0.,
-                          1., can_pressure_advance, 0.,
-                          start_v, cruise_v, accel)
-        self.last_position = move.end_pos[3]
+        trapq_moves = []
+        for print_time, move in moves:
+            axis_r = move.axes_r[3]
+            can_pressure_advance = 0.
+            if axis_r > 0. and (move.axes_d[0] or move.axes_d[1]):
+                can_pressure_advance = 1.
+            trapq_moves.extend((
+                print_time, move.accel_t, move.cruise_t, move.decel_t,
+                move.start_pos[3], 0., 0.,
+                1., can_pressure_advance, 0.,
+                move.start_v * axis_r, move.cruise_v * axis_r,
+                move.accel * axis_r))
+        self.trapq_append_batch(self.trapq, trapq_moves, len(moves))
+        self.last_position = moves[-1][1].end_pos[3]
     def find_past_position(self, print_time):
         if self.extruder_stepper is None:
             return 0.
@@ -305,6 +305,11 @@ def main():
                     help="input tty name (default is /tmp/printer)")
     opts.add_option("-a", "--api-server", dest="apiserver",
                     help="api server unix domain socket filename")
+    opts.add_option("--status-shm", dest="status_shm",
+                    help="export printer status to shared memory file")
+    opts.add_option("--no-template-cache", action="store_false",
+                    dest="template_cache", default=True,
+                    help="do not cache compiled g-code templates on disk")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
     opts.add_option("-v", action="store_true", dest="verbose",
@@ -324,6 +329,7 @@ def main():
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
     start_args = {'config_file': args[0], 'apiserver': options.apiserver,
+                  'template_cache': options.template_cache,
                   'start_reason': 'startup'}
 
     debuglevel = logging.INFO
@@ -331,6 +337,8 @@ def main():
         debuglevel = logging.DEBUG
     elif options.warn:
         debuglevel = logging.WARNING
+    if options.status_shm:
+        start_args['status_shm'] = options.status_shm
     if options.debuginput:
         start_args['debuginput'] = options.debuginput
         debuginput = open(options.debuginput, 'rb')
@@ -161,6 +161,73 @@ def convert_msg_format(msgformat):
         msgformat = msgformat.replace(c, '%s')
     return msgformat
 
+# Generate python code to parse (or encode) a single message parameter
+def _gen_parse_param(t, var, i):
+    if isinstance(t, Enumeration):
+        return _gen_parse_param(t.pt, var, i) + [
+            "e = t%d.reverse_enums.get(%s)" % (i, var),
+            "if e is None:",
+            "    e = \"?%%d\" %% (%s,)" % (var,),
+            "%s = e" % (var,)]
+    if t.is_int:
+        out = ["c = s[pos]",
+               "pos += 1",
+               "if c < 0x60:",
+               "    %s = c" % (var,),
+               "else:",
+               "    %s = c & 0x7f" % (var,),
+               "    if (c & 0x60) == 0x60:",
+               "        %s |= -0x20" % (var,),
+               "    while c & 0x80:",
+               "        c = s[pos]",
+               "        pos += 1",
+               "        %s = (%s<<7) | (c & 0x7f)" % (var, var)]
+        if not t.signed:
+            out.append("    %s &= 0xffffffff" % (var,))
+        return out
+    if isinstance(t, PT_string):
+        return ["l = s[pos]",
+                "%s = bytes(bytearray(s[pos+1:pos+l+1]))" % (var,),
+                "pos += l+1"]
+    return ["%s, pos = t%d.parse(s, pos)" % (var, i)]
+
+def _gen_encode_param(t, var, i):
+    if t.is_int and not isinstance(t, Enumeration):
+        return [
+            "if %s >= 0xc000000 or %s < -0x4000000:" % (var, var),
+            "    out.append((%s>>28) & 0x7f | 0x80)" % (var,),
+            "if %s >= 0x180000 or %s < -0x80000:" % (var, var),
+            "    out.append((%s>>21) & 0x7f | 0x80)" % (var,),
+            "if %s >= 0x3000 or %s < -0x1000:" % (var, var),
+            "    out.append((%s>>14) & 0x7f | 0x80)" % (var,),
+            "if %s >= 0x60 or %s < -0x20:" % (var, var),
+            "    out.append((%s>>7) & 0x7f | 0x80)" % (var,),
+            "out.append(%s & 0x7f)" % (var,)]
+    return ["t%d.encode(out, %s)" % (i, var)]
+
+# Create specialized parse() and encode() functions for a message
+def compile_codec(msgid, param_names):
+    env = {'t%d' % (i,): t for i, (name, t) in enumerate(param_names)}
+    code = ["def parse(s, pos):", "    pos += 1"]
+    for i, (name, t) in enumerate(param_names):
+        code.extend(["    " + l for l in _gen_parse_param(t, "p%d" % (i,), i)])
+    code.append("    return {%s}, pos" % (", ".join([
+        "%s: p%d" % (repr(name), i)
+        for i, (name, t) in enumerate(param_names)]),))
+    for func, getparam in [("encode(params)", "params[%d]"),
+                           ("encode_by_name(**params)", "params[%s]")]:
+        code.extend(["def %s:" % (func,), "    out = [%d]" % (msgid,)])
+        for i, (name, t) in enumerate(param_names):
+            if "%s" in getparam:
+                param = getparam % (repr(name),)
+            else:
+                param = getparam % (i,)
+            code.append("    v = %s" % (param,))
+            code.extend(["    " + l for l in _gen_encode_param(t, "v", i)])
+        code.append("    return out")
+    exec("\n".join(code), env)
+    return env['parse'], env['encode'], env['encode_by_name']
+
 class MessageFormat:
     def __init__(self, msgid, msgformat, enumerations={}):
         self.msgid = msgid
@@ -170,6 +237,9 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        # Replace the generic parse/encode methods with compiled versions
+        self.parse, self.encode, self.encode_by_name = compile_codec(
+            msgid, self.param_names)
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, heapq, itertools, collections
 import greenlet
 import chelper, util
 
@@ -14,6 +14,7 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.order = None
 
 class ReactorCompletion:
     class sentinel: pass
@@ -72,6 +73,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return not not self.queue
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -101,8 +104,11 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
+        # Timers (a heap of (waketime, sequence, timer) entries)
         self._timers = []
+        self._timer_count = 0
+        self._timer_seq = itertools.count()
+        self._due_timers = collections.deque()
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
@@ -117,21 +123,55 @@ class SelectReactor:
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
     # Timers
+    def _push_timer(self, timer_handler, waketime):
+        # Add a heap entry for the timer (any old entries for the timer
+        # are left in the heap and are discarded when encountered)
+        if waketime >= self.NEVER or timer_handler.order is None:
+            return
+        heapq.heappush(self._timers,
+                       (waketime, next(self._timer_seq), timer_handler))
+        if len(self._timers) > 2 * self._timer_count + 64:
+            self._compact_timers()
+    def _compact_timers(self):
+        timers = {}
+        for entry in self._timers:
+            waketime, seq, t = entry
+            if t.order is not None and t.waketime == waketime:
+                timers[t] = entry
+        self._timers = list(timers.values())
+        heapq.heapify(self._timers)
+    def _next_waketime(self):
+        timers = self._timers
+        while timers:
+            waketime, seq, t = timers[0]
+            if t.order is not None and t.waketime == waketime:
+                return waketime
+            heapq.heappop(timers)
+        return self.NEVER
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
+        self._push_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
+        timer_handler.order = next(self._timer_seq)
+        self._timer_count += 1
+        self._push_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
+        if timer_handler.order is None:
+            raise ValueError("Timer is not registered")
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        timer_handler.order = None
+        self._timer_count -= 1
+    def _requeue_due_timers(self):
+        # Return timers found due (but not yet run) to the heap
+        due_timers = self._due_timers
+        while due_timers:
+            t = due_timers.popleft()
+            self._push_timer(t, t.waketime)
+            self._next_timer = min(self._next_timer, t.waketime)
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -151,16 +191,27 @@ class SelectReactor:
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
-        for t in self._timers:
+        # Find due timers and run them in the order they were registered
+        timers = self._timers
+        due = {}
+        while timers and timers[0][0] <= eventtime:
+            waketime, seq, t = heapq.heappop(timers)
+            if t.order is not None and t.waketime == waketime:
+                due[t.order] = t
+        self._due_timers = due_timers = collections.deque(
+            [due[order] for order in sorted(due)])
+        while due_timers:
+            t = due_timers.popleft()
             waketime = t.waketime
             if eventtime >= waketime:
                 t.waketime = self.NEVER
                 t.waketime = waketime = t.callback(eventtime)
+                self._push_timer(t, waketime)
                 if g_dispatch is not self._g_dispatch:
                     self._next_timer = min(self._next_timer, waketime)
                     self._end_greenlet(g_dispatch)
                     return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        self._next_timer = min(self._next_timer, self._next_waketime())
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -220,6 +271,7 @@ class SelectReactor:
             self._all_greenlets.append(g_next)
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
+        self._requeue_due_timers()
         self._next_timer = self.NOW
         # Switch to _dispatch_loop (via _end_greenlet or direct)
         eventtime = g_next.switch()
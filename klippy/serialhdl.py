@@ -11,6 +11,8 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+PULL_BATCH_SIZE = 128
+
 class SerialReader:
     def __init__(self, reactor, warn_prefix=""):
         self.reactor = reactor
@@ -28,35 +30,73 @@ class SerialReader:
         self.background_thread = None
         # Message handlers
         self.handlers = {}
+        self.batch_handlers = {}
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
         # Sent message notification tracking
         self.last_notify_id = 0
         self.pending_notifications = {}
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (PULL_BATCH_SIZE,))
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
-            if count < 0:
+            pcount = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, PULL_BATCH_SIZE)
+            if pcount < 0:
                 break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
-                continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
+            msgs = []
+            for i in range(pcount):
+                response = responses[i]
+                if response.notify_id:
+                    # Deliver earlier messages before completing the
+                    # notification (a response precedes its ack)
+                    if msgs:
+                        self._dispatch(msgs)
+                        msgs = []
+                    params = {'#sent_time': response.sent_time,
+                              '#receive_time': response.receive_time}
+                    completion = self.pending_notifications.pop(
+                        response.notify_id)
+                    self.reactor.async_complete(completion, params)
+                    continue
+                params = self.msgparser.parse(response.msg[0:response.len])
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                msgs.append(params)
+            if msgs:
+                self._dispatch(msgs)
+    def _dispatch(self, msgs):
+        with self.lock:
+            batches = {}
+            batch_order = []
+            for params in msgs:
+                hdl = (params['#name'], params.get('oid'))
+                if hdl in self.batch_handlers:
+                    if hdl not in batches:
+                        batches[hdl] = []
+                        batch_order.append(hdl)
+                    batches[hdl].append(params)
+                    continue
+                if batches:
+                    # Deliver earlier batched messages first
+                    self._dispatch_batches(batches, batch_order)
+                try:
+                    self.handlers.get(hdl, self.handle_default)(params)
+                except:
+                    logging.exception("%sException in serial callback",
+                                      self.warn_prefix)
+            if batches:
+                self._dispatch_batches(batches, batch_order)
+    def _dispatch_batches(self, batches, batch_order):
+        # Deliver all pending messages for a batch handler in a single call
+        for hdl in batch_order:
             try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
-                    hdl(params)
+                self.batch_handlers[hdl](batches[hdl])
             except:
                 logging.exception("%sException in serial callback",
                                   self.warn_prefix)
+        batches.clear()
+        del batch_order[:]
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
     def _get_identify_data(self, eventtime):
@@ -235,6 +275,14 @@ class SerialReader:
                 del self.handlers[name, oid]
             else:
                 self.handlers[name, oid] = callback
+    def register_batch_response(self, callback, name, oid=None):
+        # The callback is passed a list of all the matching messages
+        # that were received together
+        with self.lock:
+            if callback is None:
+                del self.batch_handlers[name, oid]
+            else:
+                self.batch_handlers[name, oid] = callback
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
@@ -209,18 +209,19 @@ class MCU_stepper:
         return old_tq
     def add_active_callback(self, cb):
         self._active_callbacks.append(cb)
-    def generate_steps(self, flush_time):
+    def prepare_steps(self, flush_time):
         # Check for activity if necessary
+        sk = self._stepper_kinematics
         if self._active_callbacks:
-            sk = self._stepper_kinematics
             ret = self._itersolve_check_active(sk, flush_time)
             if ret:
                 cbs = self._active_callbacks
                 self._active_callbacks = []
                 for cb in cbs:
                     cb(ret)
-        # Generate steps
-        sk = self._stepper_kinematics
+        return sk
+    def generate_steps(self, flush_time):
+        sk = self.prepare_steps(flush_time)
         ret = self._itersolve_generate_steps(sk, flush_time)
         if ret:
             raise error("Internal error in stepcompress")
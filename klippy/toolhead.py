@@ -3,8 +3,8 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, importlib
-import mcu, chelper, kinematics.extruder
+import math, logging, importlib, array
+import mcu, chelper, stepper, kinematics.extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
@@ -12,13 +12,24 @@ import mcu, chelper, kinematics.extruder
 
 # Class to track each move request
 class Move:
+    # Moves are created at a high rate - use fixed attribute slots and
+    # allow retired moves to be reused (see ToolHead._alloc_move)
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'junction_deviation',
+        'timing_callbacks', 'is_kinematic_move', 'axes_d', 'move_d', 'axes_r',
+        'min_move_t', 'max_start_v2', 'max_cruise_v2', 'delta_v2',
+        'max_smoothed_v2', 'smooth_delta_v2',
+        'start_v', 'cruise_v', 'end_v', 'accel_t', 'cruise_t', 'decel_t')
     def __init__(self, toolhead, start_pos, end_pos, speed):
+        self.timing_callbacks = []
+        self.reset(toolhead, start_pos, end_pos, speed)
+    def reset(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
         self.junction_deviation = toolhead.junction_deviation
-        self.timing_callbacks = []
+        del self.timing_callbacks[:]
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
         self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
@@ -186,9 +197,67 @@ class MoveQueue:
             # Enough moves have been queued to reach the target flush time.
             self.flush(lazy=True)
 
+# Look-ahead queue that keeps the junction data of pending moves in
+# compact arrays and calculates junction speeds in C code (see
+# chelper/lookahead.c).  The python MoveQueue above is the reference
+# implementation of the algorithm.
+class CMoveQueue(MoveQueue):
+    def __init__(self, toolhead):
+        MoveQueue.__init__(self, toolhead)
+        self.ffi_main, ffi_lib = chelper.get_ffi()
+        self.lookahead_flush = ffi_lib.lookahead_flush
+        self.junction_limits = array.array('d')
+        self.junctions = array.array('d')
+    def reset(self):
+        MoveQueue.reset(self)
+        del self.junction_limits[:]
+        del self.junctions[:]
+    def flush(self, lazy=False):
+        self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        queue = self.queue
+        if not queue:
+            return
+        ffi_main = self.ffi_main
+        limits = ffi_main.from_buffer("struct lookahead_move[]",
+                                      self.junction_limits)
+        junctions = ffi_main.from_buffer("struct lookahead_junction[]",
+                                         self.junctions)
+        flush_count = self.lookahead_flush(limits, junctions, len(queue), lazy)
+        ffi_main.release(limits)
+        ffi_main.release(junctions)
+        if not flush_count:
+            return
+        # Generate step times for all moves ready to be flushed
+        j = self.junctions
+        for i in range(flush_count):
+            queue[i].set_junction(j[i*3], j[i*3+1], j[i*3+2])
+        self.toolhead._process_moves(queue[:flush_count])
+        # Remove processed moves from the queue
+        del queue[:flush_count]
+        del self.junction_limits[:flush_count*5]
+        del self.junctions[:flush_count*3]
+    def add_move(self, move):
+        self.queue.append(move)
+        if len(self.queue) > 1:
+            move.calc_junction(self.queue[-2])
+        self.junction_limits.extend((
+            move.max_start_v2, move.max_cruise_v2, move.delta_v2,
+            move.max_smoothed_v2, move.smooth_delta_v2))
+        self.junctions.extend((0., 0., 0.))
+        if len(self.queue) == 1:
+            return
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # Enough moves have been queued to reach the target flush time.
+            self.flush(lazy=True)
+
+LOOKAHEAD_PLANNERS = {'python': MoveQueue, 'c': CMoveQueue}
+
 MIN_KIN_TIME = 0.100
 MOVE_BATCH_TIME = 0.500
 SDS_CHECK_TIME = 0.001 # step+dir+step filter in stepcompress.c
+TRAPQ_APPEND_FIELDS = 13 # doubles per move in trapq_append_batch()
+MOVE_POOL_SIZE = 1024
 
 DRIP_SEGMENT_TIME = 0.050
 DRIP_TIME = 0.100
@@ -206,7 +275,10 @@ class ToolHead:
         self.can_pause = True
         if self.mcu.is_fileoutput():
             self.can_pause = False
-        self.move_queue = MoveQueue(self)
+        planner = config.getchoice('lookahead_planner', LOOKAHEAD_PLANNERS,
+                                   'python')
+        self.move_queue = planner(self)
+        self.move_pool = []
         self.commanded_pos = [0., 0., 0., 0.]
         self.printer.register_event_handler("klippy:shutdown",
                                             self._handle_shutdown)
@@ -244,9 +316,16 @@ class ToolHead:
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
-        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_batch = ffi_lib.trapq_append_batch
         self.trapq_finalize_moves = ffi_lib.trapq_finalize_moves
         self.step_generators = []
+        # Setup step generation pool
+        self.stepgen_steppers = []
+        stepgen_threads = config.getint('step_generation_threads', 1,
+                                        minval=1)
+        self.stepgen = ffi_main.gc(ffi_lib.stepgen_alloc(stepgen_threads),
+                                   ffi_lib.stepgen_free)
+        self.stepgen_generate_steps = ffi_lib.stepgen_generate_steps
         # Create kinematics class
         gcode = self.printer.lookup_object('gcode')
         self.Coord = gcode.Coord
@@ -276,6 +355,14 @@ class ToolHead:
         for module_name in modules:
             self.printer.load_object(config, module_name)
     # Print time tracking
+    def _generate_steps(self, flush_time, mcu_flush_time):
+        sks = [s.prepare_steps(flush_time) for s in self.stepgen_steppers]
+        ret = self.stepgen_generate_steps(self.stepgen, sks, len(sks),
+                                          flush_time, mcu_flush_time)
+        if ret:
+            raise stepper.error("Internal error in stepcompress")
+        for sg in self.step_generators:
+            sg(flush_time)
     def _update_move_time(self, next_print_time):
         batch_time = MOVE_BATCH_TIME
         kin_flush_delay = self.kin_flush_delay
@@ -283,12 +370,11 @@ class ToolHead:
         while 1:
             self.print_time = min(self.print_time + batch_time, next_print_time)
             sg_flush_time = max(lkft, self.print_time - kin_flush_delay)
-            for sg in self.step_generators:
-                sg(sg_flush_time)
+            mcu_flush_time = max(lkft, sg_flush_time - self.move_flush_time)
+            self._generate_steps(sg_flush_time, mcu_flush_time)
             free_time = max(lkft, sg_flush_time - kin_flush_delay)
             self.trapq_finalize_moves(self.trapq, free_time)
             self.extruder.update_move_time(free_time)
-            mcu_flush_time = max(lkft, sg_flush_time - self.move_flush_time)
             for m in self.all_mcus:
                 m.flush_moves(mcu_flush_time)
             if self.print_time >= next_print_time:
@@ -314,25 +400,43 @@ class ToolHead:
             self._calc_print_time()
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
+        trapq_moves = []
+        extruder_moves = []
+        timing_callbacks = []
         for move in moves:
             if move.is_kinematic_move:
-                self.trapq_append(
-                    self.trapq, next_move_time,
+                start_pos = move.start_pos
+                axes_r = move.axes_r
+                trapq_moves.extend((
+                    next_move_time,
                     move.accel_t, move.cruise_t, move.decel_t,
-                    move.start_pos[0], move.start_pos[1], move.start_pos[2],
-                    move.axes_r[0], move.axes_r[1], move.axes_r[2],
-                    move.start_v, move.cruise_v, move.accel)
+                    start_pos[0], start_pos[1], start_pos[2],
+                    axes_r[0], axes_r[1], axes_r[2],
+                    move.start_v, move.cruise_v, move.accel))
             if move.axes_d[3]:
-                self.extruder.move(next_move_time, move)
+                extruder_moves.append((next_move_time, move))
             next_move_time = (next_move_time + move.accel_t
                               + move.cruise_t + move.decel_t)
-            for cb in move.timing_callbacks:
-                cb(next_move_time)
+            if move.timing_callbacks:
+                timing_callbacks.append((next_move_time,
+                                         move.timing_callbacks))
+        # Submit the whole batch to the C code in a single call
+        if trapq_moves:
+            self.trapq_append_batch(self.trapq, trapq_moves,
+                                    len(trapq_moves) // TRAPQ_APPEND_FIELDS)
+        if extruder_moves:
+            self.extruder.process_moves(extruder_moves)
+        for cb_time, callbacks in timing_callbacks:
+            for cb in callbacks:
+                cb(cb_time)
         # Generate steps for moves
         if self.special_queuing_state:
             self._update_drip_move_time(next_move_time)
         self._update_move_time(next_move_time)
         self.last_kin_move_time = next_move_time
+        # Retired moves may be reused for new move requests
+        pool = self.move_pool
+        pool.extend(moves[:MOVE_POOL_SIZE - len(pool)])
     def flush_step_generation(self):
         # Transition from "Flushed"/"Priming"/main state to "Flushed" state
         self.move_queue.flush()
@@ -408,9 +512,16 @@ class ToolHead:
         self.commanded_pos[:] = newpos
         self.kin.set_position(newpos, homing_axes)
         self.printer.send_event("toolhead:set_position")
+    def _alloc_move(self, start_pos, end_pos, speed):
+        if self.move_pool:
+            move = self.move_pool.pop()
+            move.reset(self, start_pos, end_pos, speed)
+            return move
+        return Move(self, start_pos, end_pos, speed)
     def move(self, newpos, speed):
-        move = Move(self, self.commanded_pos, newpos, speed)
+        move = self._alloc_move(self.commanded_pos, newpos, speed)
         if not move.move_d:
+            self.move_pool.append(move)
             return
         if move.is_kinematic_move:
             self.kin.check_move(move)
@@ -520,6 +631,10 @@ class ToolHead:
         return self.trapq
     def register_step_generator(self, handler):
         self.step_generators.append(handler)
+    def register_stepper(self, mcu_stepper):
+        # Steps for registered steppers are generated by the step
+        # generation thread pool
+        self.stepgen_steppers.append(mcu_stepper)
     def note_step_generation_scan_time(self, delay, old_delay=0.):
         self.flush_step_generation()
         cur_delay = self.kin_flush_delay
@@ -3,10 +3,13 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, json, collections
-import gcode
+import logging, socket, os, sys, errno, json, collections, itertools
+import mmap, struct
+import gcode, chelper
 
 REQUEST_LOG_SIZE = 20
+RECEIVE_SIZE = 64 * 1024
+MAX_SEND_BUFFERS = 64
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
@@ -26,6 +29,13 @@ if sys.version_info.major < 3:
                     for k, v in data.items()}
         return data
 
+# Numpy arrays (and similar objects) are sent as json lists
+def json_default(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("Object of type %s is not JSON serializable"
+                    % (type(obj).__name__,))
+
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -180,9 +190,15 @@ class ClientConnection:
         self.server = server
         self.uid = id(self)
         self.sock = sock
+        # socket.sendmsg() is not available on Python 2
+        self.has_sendmsg = hasattr(sock, 'sendmsg')
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received, self._do_send)
-        self.partial_data = self.send_buffer = b""
+        self.partial_data = b""
+        self.send_queue = collections.deque()
+        self.pending_requests = collections.deque()
+        self.dispatch_timer = self.reactor.register_timer(
+            self._process_requests)
         self.is_blocking = False
         self.blocking_count = 0
         self.set_client_info("?", "New connection")
@@ -213,6 +229,9 @@ class ClientConnection:
         self.set_client_info(None, "Disconnected")
         self.reactor.unregister_fd(self.fd_handle)
         self.fd_handle = None
+        self.send_queue.clear()
+        if not self.pending_requests:
+            self._unregister_dispatch()
         try:
             self.sock.close()
         except socket.error:
@@ -224,7 +243,7 @@ class ClientConnection:
 
     def process_received(self, eventtime):
         try:
-            data = self.sock.recv(4096)
+            data = self.sock.recv(RECEIVE_SIZE)
         except socket.error as e:
             # If bad file descriptor allow connection to be
             # closed by the data check
@@ -247,8 +266,29 @@ class ClientConnection:
                 logging.exception("webhooks: Error decoding Server Request %s"
                                   % (req))
                 continue
-            self.reactor.register_callback(
-                lambda e, s=self, wr=web_request: s._process_request(wr))
+            self.pending_requests.append(web_request)
+        if self.pending_requests:
+            self.reactor.update_timer(self.dispatch_timer, self.reactor.NOW)
+
+    def _unregister_dispatch(self):
+        if self.dispatch_timer is not None:
+            self.reactor.unregister_timer(self.dispatch_timer)
+            self.dispatch_timer = None
+
+    def _process_requests(self, eventtime):
+        # Process all received requests from a single timer callback
+        pending_requests = self.pending_requests
+        while pending_requests:
+            web_request = pending_requests.popleft()
+            if pending_requests and self.dispatch_timer is not None:
+                # Should this request block, the timer will be
+                # reinvoked (in a new greenlet) to handle the remainder
+                self.reactor.update_timer(self.dispatch_timer,
+                                          self.reactor.NOW)
+            self._process_request(web_request)
+        if self.fd_handle is None:
+            self._unregister_dispatch()
+        return self.reactor.NEVER
 
     def _process_request(self, web_request):
         try:
@@ -268,23 +308,52 @@ class ClientConnection:
         self.send(result)
 
     def send(self, data):
-        jmsg = json.dumps(data, separators=(',', ':'))
-        self.send_buffer += jmsg.encode() + b"\x03"
+        jmsg = json.dumps(data, separators=(',', ':'), default=json_default)
+        self.send_encoded(jmsg.encode())
+
+    def send_encoded(self, jmsg):
+        # Send an already json encoded message
+        if self.fd_handle is None:
+            return
+        self.send_queue.append(jmsg)
+        self.send_queue.append(b"\x03")
         if not self.is_blocking:
             self._do_send()
 
     def _do_send(self, eventtime=None):
         if self.fd_handle is None:
             return
-        try:
-            sent = self.sock.send(self.send_buffer)
-        except socket.error as e:
-            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
-                logging.info("webhooks: socket write error %d" % (self.uid,))
-                self.close()
-                return
-            sent = 0
-        if sent < len(self.send_buffer):
+        send_queue = self.send_queue
+        while send_queue:
+            # Write queued messages with a single vectored write
+            bufs = list(itertools.islice(send_queue, MAX_SEND_BUFFERS))
+            try:
+                if self.has_sendmsg:
+                    sent = self.sock.sendmsg(bufs)
+                else:
+                    sent = self.sock.send(b"".join(
+                        [b.tobytes() if isinstance(b, memoryview) else b
+                         for b in bufs]))
+            except socket.error as e:
+                if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    logging.info("webhooks: socket write error %d"
+                                 % (self.uid,))
+                    self.close()
+                    return
+                sent = 0
+            is_partial = sent < sum([len(buf) for buf in bufs])
+            # Discard the data that was written
+            while sent:
+                buf_len = len(send_queue[0])
+                if sent < buf_len:
+                    send_queue[0] = memoryview(send_queue[0])[sent:]
+                    break
+                send_queue.popleft()
+                sent -= buf_len
+            if is_partial:
+                # Wait for the socket to become writable
+                break
+        if send_queue:
             if not self.is_blocking:
                 self.reactor.set_fd_wake(self.fd_handle, False, True)
                 self.is_blocking = True
@@ -292,7 +361,6 @@ class ClientConnection:
         elif self.is_blocking:
             self.reactor.set_fd_wake(self.fd_handle, True, False)
             self.is_blocking = False
-        self.send_buffer = self.send_buffer[sent:]
 
 class WebHooks:
     def __init__(self, printer):
@@ -352,7 +420,8 @@ class WebHooks:
                     'hostname': socket.gethostname(),
                     'klipper_path': klipper_path, 'python_path': sys.executable}
         start_args = self.printer.get_start_args()
-        for sa in ['log_file', 'config_file', 'software_version', 'cpu_info']:
+        for sa in ['log_file', 'config_file', 'software_version', 'cpu_info',
+                   'status_shm']:
             response[sa] = start_args.get(sa)
         web_request.send(response)
 
@@ -452,54 +521,104 @@ class QueryStatusHelper:
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        self.last_versions = {}
+        # Setup optional shared memory status export
+        self.status_export = None
+        shm_filename = printer.get_start_args().get('status_shm')
+        if shm_filename is not None:
+            self.status_export = StatusExport(printer, shm_filename)
+            printer.register_event_handler("klippy:ready",
+                                           self._handle_ready)
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
         webhooks.register_endpoint("objects/query", self._handle_query)
         webhooks.register_endpoint("objects/subscribe", self._handle_subscribe)
+    def _handle_ready(self):
+        reactor = self.printer.get_reactor()
+        reactor.register_timer(self._do_export, reactor.NOW)
+    def _do_export(self, eventtime):
+        self.status_export.update(eventtime)
+        return eventtime + SUBSCRIPTION_REFRESH_TIME
     def _handle_list(self, web_request):
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _query_object(self, obj_name, eventtime, last_query, query):
+        # Returns the object's status and whether it may have changed
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            query[obj_name] = {}
+            return {}, False
+        if hasattr(po, 'get_status_version'):
+            # Object reports when its status changes - skip it if idle
+            version = po.get_status_version()
+            if (obj_name in last_query
+                and self.last_versions.get(obj_name) == version):
+                res = query[obj_name] = last_query[obj_name]
+                return res, False
+            self.last_versions[obj_name] = version
+        res = query[obj_name] = po.get_status(eventtime)
+        return res, True
+    def _build_status(self, subscription, eventtime, last_query, query,
+                      changed, is_query):
+        cquery = {}
+        for obj_name, req_items in subscription.items():
+            res = query.get(obj_name, None)
+            if res is None:
+                res, changed[obj_name] = self._query_object(
+                    obj_name, eventtime, last_query, query)
+            if req_items is None:
+                req_items = list(res.keys())
+                if req_items:
+                    subscription[obj_name] = req_items
+            if is_query:
+                cquery[obj_name] = {ri: res.get(ri, None) for ri in req_items}
+                continue
+            if not changed[obj_name]:
+                continue
+            lres = last_query.get(obj_name, {})
+            cres = {}
+            for ri in req_items:
+                rd = res.get(ri, None)
+                lrd = lres.get(ri)
+                if rd is not lrd and rd != lrd:
+                    cres[ri] = rd
+            if cres:
+                cquery[obj_name] = cres
+        return cquery
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
-        msglist = self.pending_queries
+        changed = {}
+        # Respond to pending queries
+        pending_queries = self.pending_queries
         self.pending_queries = []
-        msglist.extend(self.clients.values())
-        # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
-            is_query = cconn is None
-            if not is_query and cconn.is_closed():
+        for subscription, send_func in pending_queries:
+            cquery = self._build_status(subscription, eventtime, last_query,
+                                        query, changed, True)
+            send_func({'params': {'eventtime': eventtime, 'status': cquery}})
+        # Send updates to subscribed clients (clients with the same
+        # subscription share a single json encoding of the update)
+        encoded = {}
+        for cconn, (subscription, msg_prefix) in list(self.clients.items()):
+            if cconn.is_closed():
                 del self.clients[cconn]
                 continue
-            # Query each requested printer object
-            cquery = {}
-            for obj_name, req_items in subscription.items():
-                res = query.get(obj_name, None)
-                if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
-                if req_items is None:
-                    req_items = list(res.keys())
-                    if req_items:
-                        subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
-                cres = {}
-                for ri in req_items:
-                    rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
-                        cres[ri] = rd
-                if cres or is_query:
-                    cquery[obj_name] = cres
-            # Send data
-            if cquery or is_query:
-                tmp = dict(template)
-                tmp['params'] = {'eventtime': eventtime, 'status': cquery}
-                send_func(tmp)
+            sub_key = tuple([(obj_name, ri if ri is None else tuple(ri))
+                             for obj_name, ri in subscription.items()])
+            jparams = encoded.get(sub_key)
+            if jparams is None:
+                cquery = self._build_status(subscription, eventtime,
+                                            last_query, query, changed, False)
+                jparams = b""
+                if cquery:
+                    jparams = json.dumps(
+                        {'eventtime': eventtime, 'status': cquery},
+                        separators=(',', ':')).encode()
+                encoded[sub_key] = jparams
+            if jparams:
+                cconn.send_encoded(msg_prefix + jparams + b"}")
         if not query:
             # Unregister timer if there are no longer any subscriptions
             reactor = self.printer.get_reactor()
@@ -524,7 +643,7 @@ class QueryStatusHelper:
             del self.clients[cconn]
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        self.pending_queries.append((objects, complete.complete))
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
@@ -533,10 +652,123 @@ class QueryStatusHelper:
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            # Pre-encode the response template (the params are appended
+            # to it when an update is sent)
+            tmp = dict(template)
+            tmp.pop('params', None)
+            msg_prefix = json.dumps(tmp, separators=(',', ':'))[:-1]
+            if tmp:
+                msg_prefix += ','
+            msg_prefix = (msg_prefix + '"params":').encode()
+            self.clients[cconn] = (objects, msg_prefix)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
+# Shared memory status export layout (see API_Server.md).  The header
+# contains the magic, layout version, total size, sequence counter, and
+# maximum number of temperature entries.
+SHM_MAGIC = b"KLIPSTAT"
+SHM_LAYOUT_VERSION = 1
+SHM_HEADER_FORMAT = "<8sIIII8x"
+SHM_SEQUENCE_OFFSET = 16
+SHM_MAX_TEMPERATURES = 16
+SHM_PRINT_STATES = ["standby", "printing", "paused", "complete",
+                    "cancelled", "error"]
+SHM_STATUS_FORMAT = "<d4d4d2d3dii256s"
+SHM_TEMPERATURE_FORMAT = "<32s3d"
+
+# Strings are already bytes on Python 2 (and encoding them there would
+# first decode them as ascii)
+def encode_shm_string(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return s
+
+# Publish a fixed subset of the printer status to a memory mapped file
+class StatusExport:
+    def __init__(self, printer, filename):
+        self.printer = printer
+        self.filename = filename
+        self.sensors = []
+        self.data_offset = struct.calcsize(SHM_HEADER_FORMAT)
+        self.status_size = struct.calcsize(SHM_STATUS_FORMAT)
+        self.temp_size = struct.calcsize(SHM_TEMPERATURE_FORMAT)
+        data_size = self.status_size + self.temp_size * SHM_MAX_TEMPERATURES
+        self.size = self.data_offset + data_size
+        self.data = bytearray(data_size)
+        # Map the file (an existing file is reused so that readers that
+        # already mapped it continue to see updates)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            self.mmap = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        header = self.mmap[:self.data_offset]
+        seq = 0
+        if header[:len(SHM_MAGIC)] == SHM_MAGIC:
+            seq = struct.unpack_from("<I", header, SHM_SEQUENCE_OFFSET)[0]
+        struct.pack_into(SHM_HEADER_FORMAT, self.mmap, 0, SHM_MAGIC,
+                         SHM_LAYOUT_VERSION, self.size, seq & ~1,
+                         SHM_MAX_TEMPERATURES)
+        ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.c_base = ffi_main.from_buffer(self.mmap)
+        printer.register_event_handler("klippy:ready", self._handle_ready)
+        printer.register_event_handler("klippy:disconnect",
+                                       self._handle_disconnect)
+    def _handle_ready(self):
+        pheaters = self.printer.lookup_object('heaters', None)
+        if pheaters is not None:
+            sensors = pheaters.get_status(0.)['available_sensors']
+            if len(sensors) > SHM_MAX_TEMPERATURES:
+                logging.info("Status export limited to %d temperatures",
+                             SHM_MAX_TEMPERATURES)
+            self.sensors = sensors[:SHM_MAX_TEMPERATURES]
+    def _handle_disconnect(self):
+        if self.mmap is not None:
+            self.c_base = None
+            self.mmap.close()
+            self.mmap = None
+    def _get_status(self, obj_name, eventtime):
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}
+        return po.get_status(eventtime)
+    def update(self, eventtime):
+        if self.mmap is None:
+            return
+        th_status = self._get_status('toolhead', eventtime)
+        mr_status = self._get_status('motion_report', eventtime)
+        ps_status = self._get_status('print_stats', eventtime)
+        position = th_status.get('position', (0., 0., 0., 0.))
+        live_pos = mr_status.get('live_position', (0., 0., 0., 0.))
+        state = ps_status.get('state')
+        state_id = -1
+        if state in SHM_PRINT_STATES:
+            state_id = SHM_PRINT_STATES.index(state)
+        filename = encode_shm_string(ps_status.get('filename', ''))[:255]
+        struct.pack_into(
+            SHM_STATUS_FORMAT, self.data, 0, eventtime,
+            position[0], position[1], position[2], position[3],
+            live_pos[0], live_pos[1], live_pos[2], live_pos[3],
+            mr_status.get('live_velocity', 0.),
+            mr_status.get('live_extruder_velocity', 0.),
+            ps_status.get('total_duration', 0.),
+            ps_status.get('print_duration', 0.),
+            ps_status.get('filament_used', 0.),
+            state_id, len(self.sensors), filename)
+        offset = self.status_size
+        for name in self.sensors:
+            status = self._get_status(name, eventtime)
+            struct.pack_into(
+                SHM_TEMPERATURE_FORMAT, self.data, offset,
+                encode_shm_string(name)[:31], status.get('temperature', 0.),
+                status.get('target', 0.), status.get('power', 0.))
+            offset += self.temp_size
+        self.ffi_lib.seqlock_write(self.c_base, SHM_SEQUENCE_OFFSET,
+                                   self.data_offset, bytes(self.data),
+                                   len(self.data))
+
 def add_early_printer_objects(printer):
     printer.add_object('webhooks', WebHooks(printer))
     GCodeHelper(printer)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Measure the G-Code parsing and dispatch rate of the host software
+#
+# Copyright (C) 2026  Klipper contributors
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, logging, importlib
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import gcode
+
+# Minimal stand-ins for the printer objects that g-code dispatch needs
+class StubMutex:
+    def __enter__(self):
+        pass
+    def __exit__(self, type=None, value=None, tb=None):
+        pass
+
+class StubReactor:
+    def mutex(self):
+        return StubMutex()
+
+class StubToolhead:
+    def __init__(self):
+        self.position = [0., 0., 0., 0.]
+        self.move_count = 0
+    def move(self, newpos, speed):
+        self.position[:] = newpos
+        self.move_count += 1
+    def get_position(self):
+        return list(self.position)
+
+class StubPrinter:
+    command_error = gcode.CommandError
+    def __init__(self):
+        self.reactor = StubReactor()
+        self.objects = {'toolhead': StubToolhead()}
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return self.reactor
+    def register_event_handler(self, event, callback):
+        pass
+    def send_event(self, event, *params):
+        pass
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+
+class StubConfig:
+    def __init__(self, printer):
+        self.printer = printer
+    def get_printer(self):
+        return self.printer
+
+def setup_dispatch(use_fast_parse):
+    printer = StubPrinter()
+    gcode_dispatch = gcode.GCodeDispatch(printer)
+    printer.add_object('gcode', gcode_dispatch)
+    gcode_move = importlib.import_module('extras.gcode_move')
+    gm = gcode_move.load_config(StubConfig(printer))
+    gcode_dispatch._handle_ready()
+    gm._handle_ready()
+    if not use_fast_parse:
+        gcode_dispatch._parse_move_command = (lambda line: (None, None))
+    return gcode_dispatch, printer.lookup_object('toolhead')
+
+# Generate a slicer like stream of short extruding moves
+def generate_gcode(count):
+    out = ["G90", "M83", "G1 Z0.2 F3000"]
+    for i in range(count):
+        angle = i * 0.05
+        radius = 50. + 20. * math.sin(i * 0.001)
+        out.append("G1 X%.3f Y%.3f E%.5f" % (
+            100. + radius * math.cos(angle), 100. + radius * math.sin(angle),
+            0.0123))
+        if i % 1000 == 999:
+            feedrate = 1200 + (i // 1000) % 5 * 600
+            out.append("G1 F%d ; speed change" % (feedrate,))
+    return out
+
+def read_gcode(filename):
+    f = open(filename, 'r')
+    lines = f.read().split('\n')
+    f.close()
+    return lines
+
+def run_benchmark(lines, use_fast_parse):
+    gcode_dispatch, toolhead = setup_dispatch(use_fast_parse)
+    start_time = time.time()
+    gcode_dispatch._process_commands(lines, need_ack=False)
+    total_time = time.time() - start_time
+    return total_time, toolhead.move_count
+
+def main():
+    usage = "%prog [options] [<gcode file>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--lines", type="int", dest="lines", default=200000,
+                    help="number of moves to generate if no file given")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of times to run each test")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    if args:
+        lines = read_gcode(args[0])
+    else:
+        lines = generate_gcode(options.lines)
+    for name, use_fast_parse in [("generic parser", False),
+                                 ("move fast path", True)]:
+        best_time = None
+        for i in range(options.repeat):
+            total_time, move_count = run_benchmark(lines, use_fast_parse)
+            if best_time is None or total_time < best_time:
+                best_time = total_time
+        print("%-15s: %d lines (%d moves) in %.3fs - %.0f lines/s" % (
+            name, len(lines), move_count, best_time, len(lines) / best_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Measure the message decode and encode rate of the host protocol code
+#
+# Copyright (C) 2026  Klipper contributors
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import msgproto
+
+def read_file(filename):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+# Extract the individual messages from a capture of message blocks
+def extract_messages(mp, data):
+    data = bytearray(data)
+    msgs = []
+    while len(data) >= msgproto.MESSAGE_MIN:
+        msglen = data[msgproto.MESSAGE_POS_LEN]
+        if (msglen < msgproto.MESSAGE_MIN or msglen > msgproto.MESSAGE_MAX
+            or msglen > len(data)):
+            raise Exception("Invalid message block in capture file")
+        block = data[:msglen]
+        data = data[msglen:]
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < msglen - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id.get(block[pos], mp.unknown)
+            if not isinstance(mid, msgproto.MessageFormat):
+                break
+            msgs.append((mid, block, pos))
+            params, pos = msgproto.MessageFormat.parse(mid, block, pos)
+    return msgs
+
+def run_decode(msgs, use_compiled):
+    if use_compiled:
+        start_time = time.time()
+        for mid, block, pos in msgs:
+            mid.parse(block, pos)
+    else:
+        parse = msgproto.MessageFormat.parse
+        start_time = time.time()
+        for mid, block, pos in msgs:
+            parse(mid, block, pos)
+    return time.time() - start_time
+
+def run_encode(msgs, use_compiled):
+    args = []
+    for mid, block, pos in msgs:
+        params, pos = mid.parse(block, pos)
+        args.append((mid, [params[name] for name, t in mid.param_names]))
+    if use_compiled:
+        start_time = time.time()
+        for mid, params in args:
+            mid.encode(params)
+    else:
+        encode = msgproto.MessageFormat.encode
+        start_time = time.time()
+        for mid, params in args:
+            encode(mid, params)
+    return time.time() - start_time
+
+def check_results(msgs):
+    for mid, block, pos in msgs:
+        params, next_pos = mid.parse(block, pos)
+        if (params, next_pos) != msgproto.MessageFormat.parse(mid, block, pos):
+            raise Exception("Mismatch decoding %s" % (mid.name,))
+        cmd = mid.encode([params[name] for name, t in mid.param_names])
+        if cmd != list(block[pos:next_pos]):
+            raise Exception("Mismatch encoding %s" % (mid.name,))
+
+def main():
+    usage = "%prog [options] <dictionary file> <capture file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of times to run each test")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    mp = msgproto.MessageParser()
+    mp.process_identify(read_file(args[0]), decompress=False)
+    msgs = extract_messages(mp, read_file(args[1]))
+    if not msgs:
+        opts.error("No messages found in capture file")
+    check_results(msgs)
+    for name, func in [("decode", run_decode), ("encode", run_encode)]:
+        for path, use_compiled in [("generic", False), ("compiled", True)]:
+            best_time = min([func(msgs, use_compiled)
+                             for i in range(options.repeat)])
+            print("%s %-8s: %d messages in %.3fs - %.0f msgs/s" % (
+                name, path, len(msgs), best_time, len(msgs) / best_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Measure the timer dispatch overhead of the host reactor
+#
+# Copyright (C) 2026  Klipper contributors
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import reactor
+
+# Timer that is rescheduled at a fixed interval (similar to heater,
+# fan, and statistics timers)
+class PeriodicTimer:
+    def __init__(self, reactor, period):
+        self.period = period
+        self.count = 0
+        reactor.register_timer(self.callback, reactor.monotonic() + period)
+    def callback(self, eventtime):
+        self.count += 1
+        return eventtime + self.period
+
+# Timer that is continually rescheduled to run immediately
+class BusyTimer:
+    def __init__(self, reactor, duration):
+        self.reactor = reactor
+        self.count = 0
+        self.end_time = reactor.monotonic() + duration
+        reactor.register_timer(self.callback, reactor.NOW)
+    def callback(self, eventtime):
+        self.count += 1
+        if eventtime >= self.end_time:
+            self.reactor.end()
+            return self.reactor.NEVER
+        return self.reactor.NOW
+
+def run_benchmark(reactor_class, num_timers, duration):
+    r = reactor_class()
+    periodic = [PeriodicTimer(r, .050 + .950 * i / num_timers)
+                for i in range(num_timers)]
+    busy = BusyTimer(r, duration)
+    start_time = time.time()
+    r.run()
+    total_time = time.time() - start_time
+    r.finalize()
+    return total_time, busy.count, sum([t.count for t in periodic])
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--timers", type="string", dest="timers",
+                    default="10,200",
+                    help="comma separated list of timer counts to test")
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=2., help="duration (in seconds) of each test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    for num_timers in [int(n) for n in options.timers.split(',')]:
+        total_time, busy_count, periodic_count = run_benchmark(
+            reactor.Reactor, num_timers, options.duration)
+        print("%4d timers: %d dispatches (%d periodic) in %.3fs"
+              " - %.2fus per dispatch" % (
+                  num_timers, busy_count, periodic_count, total_time,
+                  total_time * 1000000. / busy_count))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# Measure the step generation rate of the host C helper code
+#
+# Copyright (C) 2026  Klipper contributors
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, tempfile, json, zlib
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import chelper, msgproto
+from extras import shaper_defs
+
+MCU_FREQ = 72000000.
+MAX_ERROR = .000025
+BATCH_TIME = .500
+HISTORY_MAX = 4096
+SHAPER_TYPE = 'mzv'
+SHAPER_FREQ = 50.
+PRESSURE_ADVANCE = .040
+PA_SMOOTH_TIME = .040
+
+# Encoded size (message id and oid) of queue_step and set_next_step_dir
+QUEUE_STEP_SIZE = 2
+SET_NEXT_STEP_DIR_SIZE = 3
+
+ROTARY_STEP_DIST = 2. * math.pi / (200. * 16. * 107./16. * 60./16.)
+
+# Available stepper kinematics: name, alloc function, alloc
+# parameters, trapq name, step distance, and the xy offset of the
+# (centered) moves
+Kinematics = [
+    ("cartesian_x", 'cartesian_stepper_alloc', [b'x'], 'toolhead', .0125,
+     (0., 0.)),
+    ("cartesian_y", 'cartesian_stepper_alloc', [b'y'], 'toolhead', .0125,
+     (0., 0.)),
+    ("cartesian_z", 'cartesian_stepper_alloc', [b'z'], 'toolhead', .0025,
+     (0., 0.)),
+    ("corexy_plus", 'corexy_stepper_alloc', [b'+'], 'toolhead', .0125,
+     (0., 0.)),
+    ("corexy_minus", 'corexy_stepper_alloc', [b'-'], 'toolhead', .0125,
+     (0., 0.)),
+    ("corexz_plus", 'corexz_stepper_alloc', [b'+'], 'toolhead', .0125,
+     (0., 0.)),
+    ("corexz_minus", 'corexz_stepper_alloc', [b'-'], 'toolhead', .0125,
+     (0., 0.)),
+    ("delta_a", 'delta_stepper_alloc',
+     [333.**2, 174.75 * math.cos(math.radians(210.)),
+      174.75 * math.sin(math.radians(210.))], 'toolhead', .0125, (0., 0.)),
+    ("deltesian_left", 'deltesian_stepper_alloc', [217.**2, -160.],
+     'toolhead', .0125, (0., 0.)),
+    ("polar_angle", 'polar_stepper_alloc', [b'a'], 'toolhead',
+     2. * math.pi / (200. * 16. * 80./16.), (60., 0.)),
+    ("polar_radius", 'polar_stepper_alloc', [b'r'], 'toolhead', .0125,
+     (60., 0.)),
+    ("rotary_delta_a", 'rotary_delta_stepper_alloc',
+     [33.9, 412.9, math.radians(30.), 170., 320.], 'toolhead',
+     ROTARY_STEP_DIST, (0., 0.)),
+    ("winch_a", 'winch_stepper_alloc', [0., -2000., -100.], 'toolhead',
+     .0125, (0., 0.)),
+    ("extruder", 'extruder_stepper_alloc', [], 'extruder', .0025, None),
+]
+
+# Test variants: name, use the closed form solver, input shaping,
+# pressure advance
+Variants = [
+    ("default", True, False, False),
+    ("iterative", False, False, False),
+    ("input_shaper", True, True, False),
+    ("pressure_advance", True, False, True),
+]
+
+######################################################################
+# Move sources
+######################################################################
+
+# Add a trapezoid move (as produced by the toolhead) to a move list
+def add_trapezoid(moves, print_time, start_pos, end_pos, start_v, cruise_v,
+                  end_v, accel):
+    axes_d = [e - s for s, e in zip(start_pos, end_pos)]
+    move_d = math.sqrt(sum([d*d for d in axes_d]))
+    axes_r = [d / move_d for d in axes_d]
+    accel_d = (cruise_v**2 - start_v**2) / (2. * accel)
+    decel_d = (cruise_v**2 - end_v**2) / (2. * accel)
+    if accel_d + decel_d > move_d:
+        # Move too short to reach cruise velocity
+        cruise_v = math.sqrt(accel * move_d + .5 * (start_v**2 + end_v**2))
+        accel_d = (cruise_v**2 - start_v**2) / (2. * accel)
+        decel_d = move_d - accel_d
+    cruise_d = move_d - accel_d - decel_d
+    pos_d = 0.
+    for v0, v1, d in [(start_v, cruise_v, accel_d), (cruise_v, cruise_v,
+                      cruise_d), (cruise_v, end_v, decel_d)]:
+        if d <= 0.:
+            continue
+        move_t = 2. * d / (v0 + v1)
+        pos = [s + r * pos_d for s, r in zip(start_pos, axes_r)]
+        moves.append((print_time, move_t, v0, (v1 - v0) / move_t, pos,
+                      axes_r))
+        print_time += move_t
+        pos_d += d
+    return print_time
+
+# Generate a print like sequence of moves (perimeters and infill)
+def generate_moves(count):
+    toolhead_moves = []
+    extruder_moves = []
+    print_time = 2.
+    pos = [100., 100., .2]
+    epos = 0.
+    accel, scv = 3000., 5.
+    for i in range(count):
+        layer, idx = divmod(i, 200)
+        if idx < 40:
+            # Circular perimeter
+            angle = 2. * math.pi * idx / 40.
+            new_pos = [100. + 30. * math.cos(angle),
+                       100. + 30. * math.sin(angle), .2 + .2 * layer]
+            speed = 60.
+        else:
+            # Zig-zag infill
+            row = idx - 40
+            new_pos = [80. + 40. * ((row // 2) % 2),
+                       80. + .4 * row, .2 + .2 * layer]
+            speed = 150.
+        if new_pos == pos:
+            continue
+        start_time = print_time
+        print_time = add_trapezoid(toolhead_moves, print_time, pos, new_pos,
+                                   scv, speed, scv, accel)
+        move_d = math.sqrt(sum([(n - p)**2 for n, p in zip(new_pos, pos)]))
+        e_d = .04 * move_d
+        # Extruder moves share the toolhead timing
+        for mv in toolhead_moves[-3:]:
+            if mv[0] < start_time:
+                continue
+            pt, move_t, start_v, ac, mpos, axes_r = mv
+            d = sum([(p - s) * r for p, s, r in zip(mpos, pos, axes_r)])
+            extruder_moves.append((pt, move_t, start_v * .04, ac * .04,
+                                   [epos + .04 * d, 0., 0.], [1., 1., 0.]))
+        epos += e_d
+        pos = new_pos
+    return {'toolhead': toolhead_moves, 'extruder': extruder_moves}
+
+# Load the trapq moves from a log created by scripts/motan/data_logger.py
+def load_motan_log(log_prefix):
+    moves = {}
+    f = open(log_prefix + ".json.gz", "rb")
+    comp = zlib.decompressobj(31)
+    partial = b""
+    while 1:
+        raw_data = f.read(65536)
+        if not raw_data:
+            break
+        msgs = (partial + comp.decompress(raw_data)).split(b'\x03')
+        partial = msgs.pop()
+        for msg in msgs:
+            jmsg = json.loads(msg)
+            qid = jmsg.get('q', '')
+            if not qid.startswith('trapq:'):
+                continue
+            name = qid[len('trapq:'):]
+            moves.setdefault(name, []).extend(
+                [tuple(m) for m in jmsg['params']['data']])
+    f.close()
+    if 'toolhead' not in moves:
+        raise Exception("No toolhead trapq found in log")
+    for name, tq_moves in list(moves.items()):
+        if name != 'toolhead' and name.startswith('extruder'):
+            moves.setdefault('extruder', tq_moves)
+    return moves
+
+# Load the moves of a "motion_report/dump_trapq" API Server subscription
+# (one json encoded message per line)
+def load_api_dump(filename):
+    moves = []
+    f = open(filename, "r")
+    for line in f:
+        line = line.strip().rstrip('\x03')
+        if not line:
+            continue
+        params = json.loads(line).get('params', {})
+        moves.extend([tuple(m) for m in params.get('data', [])])
+    f.close()
+    if not moves:
+        raise Exception("No trapq moves found in %s" % (filename,))
+    return moves
+
+# Move the toolhead moves so that they are centered around the xy origin
+def center_moves(moves):
+    xs = [m[4][0] for m in moves]
+    ys = [m[4][1] for m in moves]
+    cx, cy = .5 * (min(xs) + max(xs)), .5 * (min(ys) + max(ys))
+    return [(pt, mt, sv, ac, (sp[0] - cx, sp[1] - cy, sp[2]), ar)
+            for pt, mt, sv, ac, sp, ar in moves]
+
+
+######################################################################
+# Step generation
+######################################################################
+
+# Return the number of bytes needed to transmit a queue_step command
+def get_queue_step_size(interval, count, add):
+    out = []
+    pt = msgproto.PT_int32()
+    for v in [interval, count, add]:
+        pt.encode(out, v)
+    return QUEUE_STEP_SIZE + len(out)
+
+# Generate the steps for a list of moves using one stepper kinematics
+class StepGenRun:
+    def __init__(self, kin, moves, max_error=MAX_ERROR, use_linear=True,
+                 input_shaper=False, pressure_advance=False):
+        name, alloc_func, alloc_params, trapq_name, step_dist, offset = kin
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.ffi_main, self.ffi_lib = ffi_main, ffi_lib
+        # Load moves into a trapq
+        self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+        ox, oy = offset or (0., 0.)
+        for print_time, move_t, start_v, accel, start_pos, axes_r in moves:
+            ffi_lib.trapq_append(self.trapq, print_time, move_t, 0., 0.,
+                                 start_pos[0] + ox, start_pos[1] + oy,
+                                 start_pos[2], axes_r[0], axes_r[1],
+                                 axes_r[2], start_v, start_v, accel)
+        self.start_time = moves[0][0]
+        self.end_time = moves[-1][0] + moves[-1][1]
+        # Setup stepper kinematics
+        self.orig_sk = sk = ffi_main.gc(
+            getattr(ffi_lib, alloc_func)(*alloc_params), ffi_lib.free)
+        ffi_lib.itersolve_set_linear_solver(sk, use_linear)
+        if pressure_advance:
+            ffi_lib.extruder_set_pressure_advance(sk, PRESSURE_ADVANCE,
+                                                  PA_SMOOTH_TIME)
+        if input_shaper:
+            sk = ffi_main.gc(ffi_lib.input_shaper_alloc(), ffi_lib.free)
+            if ffi_lib.input_shaper_set_sk(sk, self.orig_sk) < 0:
+                raise Exception("Input shaping not supported on %s" % (name,))
+            shaper_init = {s.name: s.init_func
+                           for s in shaper_defs.INPUT_SHAPERS}[SHAPER_TYPE]
+            A, T = shaper_init(SHAPER_FREQ, shaper_defs.DEFAULT_DAMPING_RATIO)
+            for axis in [b'x', b'y']:
+                ffi_lib.input_shaper_set_shaper_params(sk, axis, len(A), A, T)
+        self.sk = sk
+        # Setup step compression
+        self.sc = ffi_main.gc(ffi_lib.stepcompress_alloc(0),
+                              ffi_lib.stepcompress_free)
+        ffi_lib.stepcompress_fill(self.sc, int(max_error * MCU_FREQ), 1, 2)
+        ffi_lib.itersolve_set_stepcompress(sk, self.sc, step_dist)
+        ffi_lib.itersolve_set_trapq(sk, self.trapq)
+        start_pos = moves[0][4]
+        ffi_lib.itersolve_set_position(sk, start_pos[0] + ox,
+                                       start_pos[1] + oy, start_pos[2])
+        # Messages are written to a temporary file
+        self.msg_file = tempfile.TemporaryFile()
+        self.sq = ffi_main.gc(ffi_lib.serialqueue_alloc(
+            self.msg_file.fileno(), b'f', 0), ffi_lib.serialqueue_free)
+        ffi_lib.serialqueue_set_clock_est(self.sq, 1000000000000.,
+                                          ffi_lib.get_monotonic(), 0, 0)
+        self.ss = ffi_main.gc(ffi_lib.steppersync_alloc(
+            self.sq, [self.sc], 1, 500), ffi_lib.steppersync_free)
+        ffi_lib.steppersync_set_time(self.ss, 0., MCU_FREQ)
+        # Step statistics
+        self.history = ffi_main.new('struct pull_history_steps[]',
+                                    HISTORY_MAX)
+        self.last_history_clock = 0
+        self.step_clocks = None
+        self.step_count = self.msg_count = self.msg_bytes = 0
+        self.last_dir = None
+    def record_steps(self):
+        self.step_clocks = []
+    def _extract_history(self, end_clock):
+        ffi_lib = self.ffi_lib
+        res = []
+        while 1:
+            count = ffi_lib.stepcompress_extract_old(
+                self.sc, self.history, HISTORY_MAX, self.last_history_clock,
+                end_clock)
+            res.extend([(h.first_clock, h.last_clock, h.start_position,
+                         h.step_count, h.interval, h.add)
+                        for h in self.history[0:count]])
+            if count < HISTORY_MAX:
+                break
+            end_clock = self.history[count-1].first_clock
+        res = [h for h in res if h[0] >= self.last_history_clock]
+        res.reverse()
+        return res
+    def _note_history(self, end_clock):
+        for h in self._extract_history(end_clock):
+            first_clock, last_clock, start_pos, step_count, interval, add = h
+            count = abs(step_count)
+            self.step_count += count
+            self.msg_count += 1
+            self.last_history_clock = last_clock + 1
+            self.msg_bytes += get_queue_step_size(interval, count, add)
+            step_dir = step_count > 0
+            if step_dir != self.last_dir:
+                self.msg_bytes += SET_NEXT_STEP_DIR_SIZE
+                self.last_dir = step_dir
+            if self.step_clocks is not None:
+                clock = first_clock
+                for i in range(count):
+                    self.step_clocks.append(
+                        (clock, start_pos + (i if step_dir else -i)))
+                    interval += add
+                    clock += interval
+    def run(self):
+        ffi_lib = self.ffi_lib
+        total_time = 0.
+        flush_time = self.start_time
+        while flush_time < self.end_time + 1.:
+            flush_time += BATCH_TIME
+            start_time = time.time()
+            ret = ffi_lib.itersolve_generate_steps(self.sk, flush_time)
+            if ret:
+                raise Exception("Error during step generation")
+            clock = int(flush_time * MCU_FREQ)
+            ret = ffi_lib.steppersync_flush(self.ss, clock)
+            if ret:
+                raise Exception("Error during step compression")
+            total_time += time.time() - start_time
+            ffi_lib.trapq_finalize_moves(self.trapq, flush_time - 1.)
+            self._note_history(clock)
+        ffi_lib.serialqueue_exit(self.sq)
+        return total_time
+    def get_print_duration(self):
+        return self.end_time - self.start_time
+
+
+######################################################################
+# Main code
+######################################################################
+
+def check_results(kin, moves):
+    # Both solvers should produce the same steps (within a clock tick)
+    results = []
+    for use_linear in [False, True]:
+        sgr = StepGenRun(kin, moves, max_error=0., use_linear=use_linear)
+        sgr.record_steps()
+        sgr.run()
+        results.append(sgr.step_clocks)
+    iter_steps, linear_steps = results
+    if len(iter_steps) != len(linear_steps):
+        raise Exception("Step count mismatch on %s (%d vs %d)" % (
+            kin[0], len(iter_steps), len(linear_steps)))
+    max_diff = 0
+    for (iclock, ipos), (lclock, lpos) in zip(iter_steps, linear_steps):
+        if ipos != lpos:
+            raise Exception("Step position mismatch on %s" % (kin[0],))
+        max_diff = max(max_diff, abs(iclock - lclock))
+    return len(iter_steps), max_diff
+
+def run_test(kin, variant, moves, repeat):
+    name, use_linear, input_shaper, pressure_advance = variant
+    best_time = None
+    for i in range(repeat):
+        sgr = StepGenRun(kin, moves, use_linear=use_linear,
+                         input_shaper=input_shaper,
+                         pressure_advance=pressure_advance)
+        total_time = sgr.run()
+        if best_time is None or total_time < best_time:
+            best_time = total_time
+    duration = sgr.get_print_duration()
+    print("%-15s %-17s %9d steps %10.0f steps/s %8d msgs %7.0f msgs/s"
+          " %7.1f steps/msg %6.0f bytes/s %7.0f bytes/Mstep" % (
+              kin[0], name, sgr.step_count, sgr.step_count / best_time,
+              sgr.msg_count, sgr.msg_count / duration,
+              sgr.step_count / max(1, sgr.msg_count),
+              sgr.msg_bytes / duration,
+              sgr.msg_bytes * 1000000. / max(1, sgr.step_count)))
+
+def main():
+    usage = "%prog [options] [motan log prefix]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves", default=2000,
+                    help="number of generated moves (if no log given)")
+    opts.add_option("-t", "--toolhead-dump", type="string", dest="toolhead",
+                    help="toolhead trapq dump (from motion_report)")
+    opts.add_option("-e", "--extruder-dump", type="string", dest="extruder",
+                    help="extruder trapq dump (from motion_report)")
+    opts.add_option("-k", "--kinematics", type="string", dest="kinematics",
+                    default=",".join([k[0] for k in Kinematics]),
+                    help="comma separated list of kinematics to test")
+    opts.add_option("-v", "--variants", type="string", dest="variants",
+                    default=",".join([v[0] for v in Variants]),
+                    help="comma separated list of test variants")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of times to run each test")
+    opts.add_option("-c", "--check", action="store_true", dest="check",
+                    help="check that all solvers produce the same steps")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    if args:
+        moves = load_motan_log(args[0])
+    elif options.toolhead or options.extruder:
+        moves = {}
+        if options.toolhead:
+            moves['toolhead'] = load_api_dump(options.toolhead)
+        if options.extruder:
+            moves['extruder'] = load_api_dump(options.extruder)
+    else:
+        moves = generate_moves(options.moves)
+    if moves.get('toolhead'):
+        moves['toolhead'] = center_moves(moves['toolhead'])
+    kin_names = options.kinematics.split(',')
+    variant_names = options.variants.split(',')
+    for kin in Kinematics:
+        tq_moves = moves.get(kin[3])
+        if kin[0] not in kin_names or not tq_moves:
+            continue
+        if options.check:
+            step_count, max_diff = check_results(kin, tq_moves)
+            print("%-15s check: %d steps - max difference %d clock ticks" % (
+                kin[0], step_count, max_diff))
+            continue
+        is_extruder = kin[3] == 'extruder'
+        for variant in Variants:
+            name, use_linear, input_shaper, pressure_advance = variant
+            if (name not in variant_names
+                or (input_shaper and (is_extruder or kin[0] == 'cartesian_z'))
+                or (pressure_advance and not is_extruder)):
+                continue
+            run_test(kin, variant, tq_moves, options.repeat)
+
+if __name__ == '__main__':
+    main()
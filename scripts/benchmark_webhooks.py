@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Measure the throughput of the host API server (webhooks) Unix socket
+#
+# Copyright (C) 2026  Klipper contributors
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, socket, threading, json, logging, tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import reactor, gcode, webhooks
+
+# Minimal stand-in for the printer object that webhooks needs
+class StubPrinter:
+    command_error = gcode.CommandError
+    def __init__(self, server_address):
+        self.reactor = reactor.Reactor()
+        self.start_args = {'apiserver': server_address}
+    def get_start_args(self):
+        return self.start_args
+    def get_reactor(self):
+        return self.reactor
+    def register_event_handler(self, event, callback):
+        pass
+    def set_rollover_info(self, name, info, log=True):
+        pass
+    def invoke_shutdown(self, msg):
+        logging.error("Shutdown: %s", msg)
+        self.reactor.end()
+
+# Server side endpoints used by the benchmark
+class BenchmarkEndpoints:
+    def __init__(self, printer, wh):
+        self.printer = printer
+        wh.register_endpoint("benchmark/echo", self._handle_echo)
+        wh.register_endpoint("benchmark/stream", self._handle_stream)
+        wh.register_endpoint("benchmark/end", self._handle_end)
+    def _handle_echo(self, web_request):
+        web_request.send({'data': web_request.get('data', None)})
+    def _handle_stream(self, web_request):
+        # Send a burst of unsolicited messages (similar to a sensor
+        # data dump subscription)
+        count = web_request.get_int('count')
+        data = 'x' * web_request.get_int('size')
+        cconn = web_request.get_client_connection()
+        for i in range(count):
+            cconn.send({'params': {'seq': i, 'data': data}})
+    def _handle_end(self, web_request):
+        self.printer.get_reactor().end()
+
+# Client side helpers
+class Client:
+    def __init__(self, server_address):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(server_address)
+        self.partial_data = b""
+    def send(self, msgs):
+        self.sock.sendall(b"".join([json.dumps(m).encode() + b"\x03"
+                                    for m in msgs]))
+    def receive(self, count):
+        data_len = 0
+        while count:
+            data = self.sock.recv(64 * 1024)
+            if not data:
+                raise Exception("Server closed connection")
+            data_len += len(data)
+            count -= data.count(b"\x03")
+        return data_len
+    def close(self):
+        self.sock.close()
+
+def run_requests(client, count, size):
+    data = 'x' * size
+    msgs = [{'id': i, 'method': "benchmark/echo", 'params': {'data': data}}
+            for i in range(count)]
+    start_time = time.time()
+    writer = threading.Thread(target=client.send, args=(msgs,))
+    writer.start()
+    data_len = client.receive(count)
+    writer.join()
+    return time.time() - start_time, data_len
+
+def run_stream(client, count, size):
+    start_time = time.time()
+    client.send([{'method': "benchmark/stream",
+                  'params': {'count': count, 'size': size}}])
+    data_len = client.receive(count)
+    return time.time() - start_time, data_len
+
+def run_client(server_address, options, results):
+    try:
+        client = Client(server_address)
+        for name, func, count in [
+                ("requests", run_requests, options.requests),
+                ("stream", run_stream, options.messages)]:
+            best_time = data_len = None
+            for i in range(options.repeat):
+                total_time, data_len = func(client, count, options.size)
+                if best_time is None or total_time < best_time:
+                    best_time = total_time
+            results.append((name, count, data_len, best_time))
+        client.send([{'method': "benchmark/end"}])
+        client.close()
+    except Exception:
+        logging.exception("Client error")
+        results.append(None)
+        os._exit(1)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--requests", type="int", dest="requests",
+                    default=20000, help="number of requests to send")
+    opts.add_option("-m", "--messages", type="int", dest="messages",
+                    default=20000, help="number of messages to stream")
+    opts.add_option("-s", "--size", type="int", dest="size", default=256,
+                    help="payload size of each message")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of times to run each test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    server_address = os.path.join(tmpdir, "klippy_uds")
+    printer = StubPrinter(server_address)
+    wh = webhooks.WebHooks(printer)
+    BenchmarkEndpoints(printer, wh)
+    results = []
+    client = threading.Thread(target=run_client,
+                              args=(server_address, options, results))
+    client.start()
+    printer.get_reactor().run()
+    client.join()
+    printer.get_reactor().finalize()
+    os.remove(server_address)
+    os.rmdir(tmpdir)
+    for name, count, data_len, best_time in results:
+        print("%-8s: %d messages (%d bytes) in %.3fs - %.0f msgs/s %.1f MB/s"
+              % (name, count, data_len, best_time, count / best_time,
+                 data_len / best_time / 1000000.))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Read the printer status exported by klippy to a shared memory file
+#
+# Copyright (C) 2026  Klipper contributors
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, mmap, struct, collections
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import webhooks
+
+Status = collections.namedtuple('Status', (
+    'eventtime', 'position', 'live_position', 'live_velocity',
+    'live_extruder_velocity', 'total_duration', 'print_duration',
+    'filament_used', 'state', 'filename', 'temperatures'))
+
+class StatusReader:
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        self.data_offset = struct.calcsize(webhooks.SHM_HEADER_FORMAT)
+        magic, version, size, seq, max_temps = struct.unpack_from(
+            webhooks.SHM_HEADER_FORMAT, self.mmap, 0)
+        if (magic != webhooks.SHM_MAGIC
+            or version != webhooks.SHM_LAYOUT_VERSION
+            or size > len(self.mmap)):
+            raise Exception("Unsupported status file")
+        self.size = size
+    def read_raw(self):
+        # Retry until a read does not overlap with an update
+        seq_offset = webhooks.SHM_SEQUENCE_OFFSET
+        while 1:
+            seq1 = struct.unpack_from("<I", self.mmap, seq_offset)[0]
+            if seq1 & 1:
+                time.sleep(0.)
+                continue
+            data = self.mmap[self.data_offset:self.size]
+            seq2 = struct.unpack_from("<I", self.mmap, seq_offset)[0]
+            if seq1 == seq2:
+                return seq1, data
+    def read(self):
+        seq, data = self.read_raw()
+        vals = struct.unpack_from(webhooks.SHM_STATUS_FORMAT, data, 0)
+        state_id, temp_count = vals[14:16]
+        state = None
+        if state_id >= 0 and state_id < len(webhooks.SHM_PRINT_STATES):
+            state = webhooks.SHM_PRINT_STATES[state_id]
+        offset = struct.calcsize(webhooks.SHM_STATUS_FORMAT)
+        temp_size = struct.calcsize(webhooks.SHM_TEMPERATURE_FORMAT)
+        temperatures = collections.OrderedDict()
+        for i in range(temp_count):
+            name, temp, target, power = struct.unpack_from(
+                webhooks.SHM_TEMPERATURE_FORMAT, data, offset)
+            temperatures[name.rstrip(b'\0').decode()] = (temp, target, power)
+            offset += temp_size
+        return seq, Status(vals[0], vals[1:5], vals[5:9], vals[9], vals[10],
+                           vals[11], vals[12], vals[13], state,
+                           vals[16].rstrip(b'\0').decode(), temperatures)
+
+def main():
+    usage = "%prog [options] <status file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-i", "--interval", type="float", dest="interval",
+                    default=1., help="time (in seconds) between reports")
+    opts.add_option("-c", "--count", type="int", dest="count", default=0,
+                    help="number of reports (default is to run forever)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    reader = StatusReader(args[0])
+    count = 0
+    while 1:
+        seq, status = reader.read()
+        temps = " ".join(["%s:%.1f/%.1f" % (name, temp, target)
+                          for name, (temp, target, power)
+                          in status.temperatures.items()])
+        print("%.3f pos=%s live=%s state=%s %s" % (
+            status.eventtime,
+            ",".join(["%.3f" % (p,) for p in status.position]),
+            ",".join(["%.3f" % (p,) for p in status.live_position]),
+            status.state, temps))
+        count += 1
+        if count == options.count:
+            break
+        time.sleep(options.interval)
+
+if __name__ == '__main__':
+    main()